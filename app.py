@@ -2,6 +2,7 @@
 import asyncio
 import signal
 
+from db import persistence
 from services import MQTTBroker, VendingMachine
 from utils import app_logger
 
@@ -16,6 +17,9 @@ async def shutdown(signal, vm, broker):
     await vm.close()
     await broker.stop()
 
+    # Apply queued database writes and flush them to disk
+    await asyncio.to_thread(persistence.stop)
+
     await asyncio.gather(*tasks, return_exceptions=True)
     loop = asyncio.get_running_loop()
     loop.stop()
@@ -43,7 +47,7 @@ async def main():
         app_logger.info("Vending machine connection initiated")
 
         # Connect and start broker (will auto-retry)
-        if broker.connect():
+        if await broker.connect():
             app_logger.info("MQTT Broker initial connection successful")
         else:
             app_logger.warning(
@@ -74,6 +78,7 @@ async def main():
             await vm.close()
         if broker.running:
             await broker.stop()
+        await asyncio.to_thread(persistence.stop)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,35 @@
 from tinydb import TinyDB, Query
 
+from .journal import JournalTable
+from .persistence import PersistenceWorker
+from .prices import PriceTable
+from .storage import AtomicJSONStorage, DeferredCachingMiddleware
 
-db = TinyDB("db.json")
-sales_db = TinyDB("sales.json")
-transactions_db = TinyDB("transactions.json")
+# Writes are kept in memory and flushed to disk by the persistence worker,
+# which replaces the file atomically
+db = TinyDB("db.json", storage=DeferredCachingMiddleware(AtomicJSONStorage))
+stock_db = TinyDB("stock.json", storage=DeferredCachingMiddleware(AtomicJSONStorage))
 
 
 query = Query()
-Sales = sales_db.table("sales")
-Prices = db.table("prices")
-Transaction = transactions_db.table("transactions")
+# Sales and transactions only ever grow, so they are kept in append-only
+# journals. Existing TinyDB files are imported on first start.
+Sales = JournalTable("sales.jsonl", legacy_path="sales.json", legacy_table="sales")
+Transaction = JournalTable(
+    "transactions.jsonl",
+    legacy_path="transactions.json",
+    legacy_table="transactions",
+)
+
+# MQTT publishes made while the broker is unreachable
+Outbox = JournalTable("outbox.jsonl")
+
+# eSocket reversals waiting to be acknowledged
+Reversals = JournalTable("reversals.jsonl")
+
+persistence = PersistenceWorker(
+    db.storage, stock_db.storage, Sales, Transaction, Outbox, Reversals
+)
+
+Prices = PriceTable(db.table("prices"), persistence)
+Stock = stock_db.table("stock")
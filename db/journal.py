@@ -0,0 +1,296 @@
+import bisect
+import json
+import mmap
+import os
+import threading
+
+from tinydb.table import Document
+
+from utils import system_logger as logger
+
+
+class JournalTable:
+    """
+    Append-only table stored as one JSON line per record.
+
+    Inserting a record appends a single line instead of rewriting the whole
+    file, so write cost does not grow with the number of stored records.
+    Updates append a new version of the record and removals append a
+    tombstone; compaction rewrites the file once superseded lines outnumber
+    live ones. Reads go through a memory map of the file, with only the
+    offset of every live record kept in memory.
+
+    The read API mirrors the parts of a TinyDB table used in this project:
+    insert(), all(), search(), get(), update(), remove() and len().
+
+    Record ids only ever increase, so they double as sequence numbers for
+    syncing: listeners are told about every inserted record, and archive()
+    moves records up to an acknowledged id out of the journal.
+    """
+
+    # Superseded lines tolerated before the file is compacted
+    COMPACT_MIN_DEAD = 1000
+
+    def __init__(self, path, legacy_path=None, legacy_table=None, archive_path=None):
+        self.path = path
+        self.archive_path = archive_path or f"{os.path.splitext(path)[0]}.archive.jsonl"
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._index = {}  # doc_id -> (offset, length) of its latest line
+        self._ids = []  # live ids in ascending order, for page() and archive()
+        self._dead = 0
+        self._next_id = 1
+        self._map = None
+        self._mapped_size = 0
+
+        if not os.path.exists(path) and legacy_path and os.path.exists(legacy_path):
+            self._import_legacy(legacy_path, legacy_table)
+
+        self._handle = open(path, "ab")
+        self._load()
+
+    def _import_legacy(self, legacy_path, legacy_table):
+        """Convert a TinyDB JSON file into a journal"""
+        try:
+            with open(legacy_path, "r") as f:
+                content = f.read().strip()
+            records = json.loads(content).get(legacy_table, {}) if content else {}
+        except Exception as e:
+            logger.error(f"Failed to read {legacy_path} for import: {e}")
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for doc_id in sorted(records, key=int):
+                f.write(self._encode(int(doc_id), records[doc_id]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info(f"Imported {len(records)} records from {legacy_path}")
+
+    @staticmethod
+    def _encode(doc_id, document=None):
+        if document is None:
+            line = {"id": doc_id, "deleted": True}
+        else:
+            line = {"id": doc_id, "doc": document}
+        return (json.dumps(line, separators=(",", ":")) + "\n").encode()
+
+    def _load(self):
+        """Build the offset index from the journal file"""
+        self._index = {}
+        self._dead = 0
+        offset = 0
+
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn write from a crash, drop it
+                    logger.warning(f"Dropping incomplete record at end of {self.path}")
+                    self._handle.truncate(offset)
+                    self._handle.seek(0, os.SEEK_END)
+                    break
+                try:
+                    entry = json.loads(line)
+                    doc_id = entry["id"]
+                except (ValueError, KeyError):
+                    logger.warning(f"Skipping corrupt record in {self.path}")
+                    self._dead += 1
+                    offset += len(line)
+                    continue
+
+                if doc_id in self._index:
+                    self._dead += 1
+                if entry.get("deleted"):
+                    self._dead += 1
+                    self._index.pop(doc_id, None)
+                else:
+                    self._index[doc_id] = (offset, len(line))
+                self._next_id = max(self._next_id, doc_id + 1)
+                offset += len(line)
+
+        self._ids = sorted(self._index)
+
+    def _view(self):
+        """Memory map covering everything appended so far"""
+        size = self._handle.tell()
+        if self._map is None or self._mapped_size != size:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if size:
+                with open(self.path, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._map
+
+    def _append(self, doc_id, document=None):
+        line = self._encode(doc_id, document)
+        offset = self._handle.tell()
+        self._handle.write(line)
+        self._handle.flush()
+        return offset, len(line)
+
+    def _read(self, view, doc_id):
+        offset, length = self._index[doc_id]
+        return Document(json.loads(view[offset : offset + length])["doc"], doc_id)
+
+    def add_listener(self, callback):
+        """Call callback(doc_id, document) after every insert"""
+        self._listeners.append(callback)
+
+    def insert(self, document):
+        """Append a new record and return its id"""
+        document = dict(document)
+        with self._lock:
+            doc_id = self._next_id
+            self._next_id += 1
+            self._index[doc_id] = self._append(doc_id, document)
+            self._ids.append(doc_id)
+
+        for callback in self._listeners:
+            try:
+                callback(doc_id, Document(document, doc_id))
+            except Exception as e:
+                logger.error(f"Journal listener failed for {self.path}: {e}")
+        return doc_id
+
+    def _matching_ids(self, cond, doc_ids):
+        if doc_ids is not None:
+            return list(doc_ids)
+        return [doc.doc_id for doc in self.all() if cond(doc)]
+
+    def update(self, fields, cond=None, doc_ids=None):
+        """Append updated versions of the matching records"""
+        with self._lock:
+            doc_ids = self._matching_ids(cond, doc_ids)
+            view = self._view()
+            updated = []
+            for doc_id in doc_ids:
+                if doc_id not in self._index:
+                    continue
+                document = dict(self._read(view, doc_id))
+                document.update(fields)
+                self._index[doc_id] = self._append(doc_id, document)
+                self._dead += 1
+                updated.append(doc_id)
+            self._maybe_compact()
+            return updated
+
+    def remove(self, cond=None, doc_ids=None):
+        """Append tombstones for the matching records"""
+        with self._lock:
+            doc_ids = self._matching_ids(cond, doc_ids)
+            removed = []
+            for doc_id in doc_ids:
+                if self._index.pop(doc_id, None) is None:
+                    continue
+                del self._ids[bisect.bisect_left(self._ids, doc_id)]
+                self._append(doc_id)
+                self._dead += 2
+                removed.append(doc_id)
+            self._maybe_compact()
+            return removed
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self._index)
+
+    def all(self):
+        with self._lock:
+            view = self._view()
+            return [self._read(view, doc_id) for doc_id in self._index]
+
+    def last_id(self):
+        """Id of the newest live record, 0 when the table is empty"""
+        with self._lock:
+            return self._ids[-1] if self._ids else 0
+
+    def page(self, after=0, limit=100):
+        """Up to limit records with an id above after, in id order"""
+        with self._lock:
+            view = self._view()
+            start = bisect.bisect_right(self._ids, after)
+            return [
+                self._read(view, doc_id) for doc_id in self._ids[start : start + limit]
+            ]
+
+    def search(self, cond):
+        return [doc for doc in self.all() if cond(doc)]
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None:
+            with self._lock:
+                if doc_id not in self._index:
+                    return None
+                return self._read(self._view(), doc_id)
+
+        for doc in self.all():
+            if cond(doc):
+                return doc
+        return None
+
+    def archive(self, up_to):
+        """
+        Move records with an id up to and including up_to to the archive file,
+        returns the archived ids.
+        """
+        with self._lock:
+            doc_ids = self._ids[: bisect.bisect_right(self._ids, up_to)]
+            if not doc_ids:
+                return []
+
+            view = self._view()
+            with open(self.archive_path, "ab") as f:
+                for doc_id in doc_ids:
+                    offset, length = self._index[doc_id]
+                    f.write(view[offset : offset + length])
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Only drop the records once the archive copy is on disk
+            return self.remove(doc_ids=doc_ids)
+
+    def flush(self):
+        """Make every appended record durable"""
+        with self._lock:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+
+    def _maybe_compact(self):
+        if self._dead >= self.COMPACT_MIN_DEAD and self._dead > len(self._index):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the journal with only the latest version of live records"""
+        with self._lock:
+            view = self._view()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                for doc_id, (offset, length) in self._index.items():
+                    f.write(view[offset : offset + length])
+                # Keep the highest id ever used so ids are never handed out twice
+                last_id = self._next_id - 1
+                if last_id and last_id not in self._index:
+                    f.write(self._encode(last_id))
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._handle.close()
+            os.replace(tmp_path, self.path)
+            self._handle = open(self.path, "ab")
+            self._load()
+            logger.info(f"Compacted {self.path} to {len(self._index)} records")
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._handle.close()
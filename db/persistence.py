@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+
+from utils import system_logger as logger
+
+
+class PersistenceWorker:
+    """
+    Background thread that applies database writes in submission order.
+
+    Writes are queued from the event loop and applied in batches while holding
+    ``lock``, so readers taking the same lock never see a half-applied write.
+    The storages are flushed to disk (and fsynced) outside the lock at most
+    once every FLUSH_INTERVAL seconds.
+
+    A batch may still do file I/O under the lock: journal appends, and the
+    fsyncs of JournalTable.archive() and compact(). Code on the event loop
+    must therefore take ``lock`` from a worker thread (asyncio.to_thread),
+    never directly, or the serial loop can wait behind a compaction.
+    """
+
+    BATCH_SIZE = 50
+    FLUSH_INTERVAL = 1.0  # seconds
+
+    def __init__(self, *storages):
+        self.storages = list(storages)
+        self.lock = threading.RLock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._dirty = False
+
+    def start(self):
+        """Start the worker thread if it is not running"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="persistence", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write, applied after every write submitted before it"""
+        self.start()
+        self._queue.put((func, args, kwargs))
+
+    def stop(self, timeout=None):
+        """Apply all queued writes, flush them to disk and stop the thread"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write cached data of every storage to disk"""
+        for storage in self.storages:
+            try:
+                storage.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush database to disk: {e}")
+        self._dirty = False
+
+    def _next_batch(self):
+        """Wait for the next write and collect whatever else is queued"""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.FLUSH_INTERVAL))
+            while len(batch) < self.BATCH_SIZE and batch[-1] is not None:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        last_flush = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            batch = self._next_batch()
+            if batch and batch[-1] is None:
+                stopping = True
+                batch.pop()
+
+            if batch:
+                with self.lock:
+                    for func, args, kwargs in batch:
+                        try:
+                            func(*args, **kwargs)
+                        except Exception as e:
+                            logger.error(f"Database write failed: {e}")
+                self._dirty = True
+
+            now = time.monotonic()
+            if self._dirty and (stopping or now - last_flush >= self.FLUSH_INTERVAL):
+                self.flush()
+                last_flush = now
@@ -0,0 +1,152 @@
+import uuid
+
+
+class PriceTable:
+    """
+    Prices table with an in-memory index keyed by selection number.
+
+    Lookups by selection are dictionary hits instead of table scans. Writes
+    update the index immediately on the caller's thread and hand the matching
+    TinyDB write to the persistence worker. Any number of selections changed
+    together is applied in a single read-modify-write of the table, addressed
+    by document id so no query is ever evaluated.
+
+    Every write bumps ``version`` and stamps the selections it touched, so
+    readers can ask for only what changed since a version they already hold.
+    Versions are prefixed with an id of this process, as the counter starts
+    over on restart.
+    """
+
+    def __init__(self, table, persistence):
+        self._table = table
+        self._persistence = persistence
+        self._index = {}  # selection -> document
+        self._doc_ids = {}  # selection -> TinyDB doc id, owned by the worker
+        self._epoch = uuid.uuid4().hex[:8]
+        self._counter = 0
+        self._changed = {}  # selection -> counter of its last change
+        self._load()
+
+    def _load(self):
+        with self._persistence.lock:
+            documents = self._table.all()
+
+        for document in documents:
+            selection = document.get("selection")
+            if selection is None:
+                continue
+            self._index[selection] = dict(document)
+            self._doc_ids[selection] = document.doc_id
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def version(self):
+        """Opaque version of the table contents"""
+        return f"{self._epoch}-{self._counter}"
+
+    def changes_since(self, version):
+        """
+        Selections changed after version, or None when the version is not one
+        handed out by this table and a full read is needed.
+        """
+        epoch, _, counter = str(version).partition("-")
+        if epoch != self._epoch or not counter.isdigit():
+            return None
+        counter = int(counter)
+        if counter > self._counter:
+            return None
+
+        return [
+            dict(self._index[selection])
+            for selection, changed in self._changed.items()
+            if changed > counter
+        ]
+
+    def _touch(self, selections):
+        self._counter += 1
+        for selection in selections:
+            self._changed[selection] = self._counter
+
+    def all(self):
+        """All selections in table order"""
+        return [dict(document) for document in self._index.values()]
+
+    def get_selection(self, selection):
+        """Document for a selection, or None if it is not configured"""
+        document = self._index.get(selection)
+        return dict(document) if document is not None else None
+
+    def upsert_selection(self, selection, fields):
+        """Update a selection, creating it if it does not exist"""
+        self.bulk_upsert({selection: fields})
+
+    def update_selection(self, selection, fields):
+        """Update an existing selection, returns False if it does not exist"""
+        return bool(self.bulk_update({selection: fields}))
+
+    def bulk_upsert(self, changes):
+        """
+        Apply {selection: fields} to many selections at once, creating the
+        ones that do not exist yet.
+        """
+        return self.apply(upserts=changes)[0]
+
+    def bulk_update(self, changes):
+        """
+        Apply {selection: fields} to the selections that exist, returns the
+        selections that were updated.
+        """
+        return self.apply(updates=changes)[1]
+
+    def apply(self, upserts=None, updates=None):
+        """
+        Apply upserts and updates of {selection: fields} in a single write.
+        Updates run after upserts and skip selections that do not exist.
+        Returns the upserted and the updated selections.
+        """
+        upserts = {
+            selection: dict(fields) for selection, fields in (upserts or {}).items()
+        }
+        for selection, fields in upserts.items():
+            document = self._index.setdefault(selection, {"selection": selection})
+            document.update(fields)
+
+        updates = {
+            selection: dict(fields)
+            for selection, fields in (updates or {}).items()
+            if selection in self._index
+        }
+        for selection, fields in updates.items():
+            self._index[selection].update(fields)
+
+        changes = {selection: dict(fields) for selection, fields in upserts.items()}
+        for selection, fields in updates.items():
+            changes.setdefault(selection, {}).update(fields)
+
+        if changes:
+            self._touch(changes)
+            self._persistence.submit(self._write, changes)
+        return list(upserts), list(updates)
+
+    def _write(self, changes):
+        """
+        Store {selection: fields} in one read-modify-write (persistence worker).
+
+        Uses Table._update_table, the primitive behind TinyDB's own update(),
+        so the whole batch costs a single table read and a single write.
+        """
+        for selection in changes:
+            if selection not in self._doc_ids:
+                self._doc_ids[selection] = self._table._get_next_id()
+
+        def updater(table):
+            for selection, fields in changes.items():
+                doc_id = self._doc_ids[selection]
+                if doc_id in table:
+                    table[doc_id].update(fields)
+                else:
+                    table[doc_id] = {"selection": selection, **fields}
+
+        self._table._update_table(updater)
@@ -0,0 +1,63 @@
+import json
+import os
+import sys
+
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import Storage
+
+
+class DeferredCachingMiddleware(CachingMiddleware):
+    """
+    CachingMiddleware that never writes to disk on its own.
+
+    The stock middleware flushes every WRITE_CACHE_SIZE writes, from inside
+    whatever write triggered it. Here data only reaches the disk through an
+    explicit flush(), which the persistence worker makes outside its lock.
+    """
+
+    WRITE_CACHE_SIZE = sys.maxsize
+
+
+class AtomicJSONStorage(Storage):
+    """
+    JSON file storage that never rewrites the database file in place.
+
+    Every write goes to a temporary file that is fsynced and then renamed over
+    the database, so a power cut during a write leaves either the old or the
+    new contents on disk, never a truncated file.
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__()
+        self.path = path
+        self.kwargs = kwargs
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        if not content.strip():
+            # Empty file, let TinyDB initialize the database
+            return None
+        return json.loads(content)
+
+    def write(self, data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(data, **self.kwargs))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        # Persist the rename itself
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def close(self):
+        pass
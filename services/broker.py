@@ -1,16 +1,32 @@
 import asyncio
 import json
 import os
+import time
 from asyncio import Queue
 from datetime import datetime
+from functools import partial
 
 import paho.mqtt.client as mqtt
 
-from db import Prices, query, Sales, Transaction
+from db import Outbox, Prices, Sales, Stock, Transaction, persistence, query
+from utils import ENCODINGS, TopicLatencyTracker, encode_response
 from utils import broker_logger as logger
 
+from .outbox import MessageOutbox
+from .telemetry import TelemetryPublisher
+
 
 class MQTTBroker:
+
+    METRICS_INTERVAL = 60  # seconds
+    MISC_INTERVAL = 1  # seconds between keepalive/retry checks
+    SNAPSHOT_INTERVAL = 2  # seconds between checks for changed snapshots
+    WORKER_COUNT = 4  # concurrent command handlers
+    # Responses with at least this many records are encoded in a worker thread
+    OFFLOAD_MIN_RECORDS = 50
+    PAGE_SIZE = 100  # records per sales/transactions message
+    DEFAULT_RECORD_LIMIT = 1000  # records per sales/transactions request
+
     def __init__(self, vending_machine=None):
         # Load config file
         config_path = os.path.join(
@@ -22,14 +38,29 @@ class MQTTBroker:
         self.broker = config["BROKER_IP"]
         self.port = config["BROKER_PORT"]
         self.machine_id = config["MACHINE_ID"]
+        self.telemetry_interval = config.get("TELEMETRY_INTERVAL", 1.0)
         self.vending_machine = vending_machine
         self.message_queue = Queue()
+        # Publishes made while disconnected are kept on disk until reconnect
+        self.outbox = MessageOutbox(Outbox, persistence)
 
         # Initialize MQTT client
         self.client = mqtt.Client()
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
+        # The broker marks the machine offline if the connection drops
+        self.client.will_set(
+            f"vmc/{self.machine_id}/status",
+            json.dumps({"online": False}),
+            qos=1,
+            retain=True,
+        )
+        # Drive the client socket from the asyncio loop instead of a paho thread
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
         self.running = False
         self.connected = False
 
@@ -37,9 +68,58 @@ class MQTTBroker:
 
         # Connection monitoring
         self._connection_monitor_task = None
+        self._metrics_task = None
+        self._telemetry_task = None
+        self._misc_task = None
+        self._snapshot_task = None
+        self._snapshot_keys = {}  # snapshot name -> key of the last one published
         self._reconnect_delay = 5  # seconds
         self._max_reconnect_delay = 60  # seconds
 
+        # State change events pushed to the backend as they happen
+        self.telemetry = TelemetryPublisher(
+            self._publish,
+            f"vmc/{self.machine_id}/telemetry",
+            self.telemetry_interval,
+        )
+        if vending_machine:
+            vending_machine.add_listener(self.telemetry.record)
+
+        # Command topics and their handlers
+        handlers = {
+            "ping": self._handle_ping,
+            "set_price": self._handle_price_update,
+            "set_inventory": self._handle_inventory_update,
+            "set_capacity": self._handle_capacity_update,
+            "set_stock": self._handle_set_stock,
+            "get_sales": self._handle_get_sales,
+            "get_stock": self._handle_get_stock,
+            "get_prices": self._handle_get_prices,
+            "get_transactions": self._handle_get_transactions,
+            "sync": self._handle_sync,
+            "sync_ack": self._handle_sync_ack,
+            "batch": self._handle_batch,
+        }
+        self._topic_handlers = {
+            f"vmc/{self.machine_id}/{suffix}": handler
+            for suffix, handler in handlers.items()
+        }
+        # Writes to the same selection are applied in arrival order
+        self._selection_topics = {
+            f"vmc/{self.machine_id}/{suffix}"
+            for suffix in ("set_price", "set_inventory", "set_capacity")
+        }
+        self._batch_topic = f"vmc/{self.machine_id}/batch"
+        self._key_tails = {}  # ordering key -> future of the last message using it
+        self._in_flight = 0
+        self.command_metrics = TopicLatencyTracker()
+
+        # Incremental sync: record ids are the sequence numbers, new records
+        # are pushed as they are written
+        self._sync_streams = {"sales": Sales, "transactions": Transaction}
+        for stream, table in self._sync_streams.items():
+            table.add_listener(partial(self._on_record_written, stream))
+
     def _on_connect(self, client, data, flags, rc):
         """Callback when connected to MQTT broker"""
         if rc == 0:
@@ -48,27 +128,57 @@ class MQTTBroker:
                 f"Connected to MQTT broker {self.broker} with result code {str(rc)}"
             )
 
-            # Subscribe to topics
-            topics = [
-                f"vmc/{self.machine_id}/ping",
-                f"vmc/{self.machine_id}/set_price",
-                f"vmc/{self.machine_id}/set_inventory",
-                f"vmc/{self.machine_id}/set_capacity",
-                f"vmc/{self.machine_id}/set_stock",
-                f"vmc/{self.machine_id}/get_sales",
-                f"vmc/{self.machine_id}/get_stock",
-                f"vmc/{self.machine_id}/get_prices",
-                f"vmc/{self.machine_id}/get_transactions",
-            ]
-            for topic in topics:
-                self.client.subscribe(topic)
+            # Subscribe to every command topic in one request
+            self.client.subscribe([(topic, 0) for topic in self._topic_handlers])
+
+            self._record_link_event(True)
+            self._send(
+                f"vmc/{self.machine_id}/status",
+                json.dumps({"online": True}),
+                qos=1,
+                retain=True,
+            )
+
+            # Flush buffered messages, then push unacknowledged records
+            self.loop.create_task(self._resume())
         else:
             self.connected = False
             logger.error(f"Failed to connect to MQTT broker, return code {rc}")
 
+    async def _resume(self):
+        """Catch up after (re)connecting"""
+        await self.outbox.drain(self._send)
+        await self._handle_sync({})
+
+    def _send(self, topic, payload, qos=0, retain=False):
+        """Publish a message now, returns False if it could not be queued"""
+        if not self.connected:
+            return False
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        """Publish a message, buffering it in the outbox while disconnected"""
+        # Keep publish order: while older messages are buffered, queue behind them
+        if not self.outbox.pending and self._send(topic, payload, qos, retain):
+            return
+        self.outbox.put(topic, payload, qos, retain)
+
+    def _record_link_event(self, up):
+        """Telemetry event for the MQTT link"""
+        self.telemetry.record(
+            {
+                "event": "connection",
+                "ts": round(time.time(), 3),
+                "link": "mqtt",
+                "up": up,
+            }
+        )
+
     def _on_disconnect(self, client, userdata, rc):
         """Callback when disconnected from MQTT broker"""
         self.connected = False
+        self._record_link_event(False)
         if rc != 0:
             logger.warning(f"Unexpected disconnection from MQTT broker, code: {rc}")
         else:
@@ -78,60 +188,115 @@ class MQTTBroker:
         """Queue incoming messages for async processing"""
         try:
             payload = json.loads(msg.payload.decode())
-            # Put a message in queue for async processing
-            asyncio.run_coroutine_threadsafe(
-                self.message_queue.put(
-                    {
-                        "topic": msg.topic,
-                        "payload": payload,
-                    },
-                ),
-                self.loop,
+            # Callbacks run on the event loop, so the queue can be fed directly
+            self.message_queue.put_nowait(
+                {
+                    "topic": msg.topic,
+                    "payload": payload,
+                    "received_at": time.perf_counter(),
+                },
             )
         except json.JSONDecodeError:
             logger.error(f"Invalid JSON payload received: {msg.payload}")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
 
+    @staticmethod
+    def _target_selections(payload):
+        """Selections addressed by a selection, tray or all update"""
+        selection = payload.get("selection")
+        tray = payload.get("tray")
+        if selection is not None:
+            return (selection,)
+        if isinstance(tray, int):
+            return tuple(range(tray * 10 + 1, tray * 10 + 11))
+        return tuple(range(1, 101))
+
+    def _ordering_keys(self, topic, payload):
+        """Selections a message writes to, messages sharing one run in order"""
+        if not isinstance(payload, dict):
+            return ()
+        if topic == self._batch_topic:
+            operations = payload.get("operations")
+            if not isinstance(operations, list):
+                return ()
+            keys = set()
+            for operation in operations:
+                if isinstance(operation, dict):
+                    keys.update(self._target_selections(operation))
+            return tuple(keys)
+        if topic in self._selection_topics:
+            return self._target_selections(payload)
+        return ()
+
     async def process_messages(self):
-        """Process messages from queue"""
+        """
+        Process messages from queue with WORKER_COUNT concurrent workers.
+
+        Reads and pings run in parallel, while price, inventory and capacity
+        writes wait for earlier messages touching the same selections.
+        """
+        workers = [
+            asyncio.create_task(self._message_worker())
+            for _ in range(self.WORKER_COUNT)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _message_worker(self):
+        """Take messages from the queue and run their handlers"""
         while self.running:
             try:
                 message = await asyncio.wait_for(self.message_queue.get(), timeout=1.0)
-
-                # Only process messages if connected
-                if not self.connected:
-                    logger.warning("Skipping message processing - MQTT not connected")
-                    continue
-
-                topic = message["topic"]
-                payload = message["payload"]
-
-                if topic == f"vmc/{self.machine_id}/set_price":
-                    await self._handle_price_update(payload)
-                elif topic == f"vmc/{self.machine_id}/set_inventory":
-                    await self._handle_inventory_update(payload)
-                elif topic == f"vmc/{self.machine_id}/set_capacity":
-                    await self._handle_capacity_update(payload)
-                elif topic == f"vmc/{self.machine_id}/ping":
-                    await self._handle_ping(payload)
-                elif topic == f"vmc/{self.machine_id}/get_sales":
-                    await self._handle_get_sales()
-                elif topic == f"vmc/{self.machine_id}/get_prices":
-                    await self._handle_get_prices()
-                elif topic == f"vmc/{self.machine_id}/get_transactions":
-                    await self._handle_get_transactions()
-
             except asyncio.TimeoutError:
                 # Timeout is normal, continue
                 continue
+
+            try:
+                await self._handle_message(message)
             except Exception as e:
                 logger.error(f"Error processing message from queue: {e}")
             finally:
-                try:
-                    self.message_queue.task_done()
-                except:
-                    pass
+                self.message_queue.task_done()
+
+    async def _handle_message(self, message):
+        topic = message["topic"]
+        payload = message["payload"]
+
+        handler = self._topic_handlers.get(topic)
+        if handler is None:
+            logger.warning(f"No handler for topic {topic}")
+            return
+
+        # Queue behind the previous message for each key; registering happens
+        # right after the dequeue, so the chain follows arrival order
+        keys = self._ordering_keys(topic, payload)
+        done = self.loop.create_future()
+        predecessors = set()
+        for key in keys:
+            previous = self._key_tails.get(key)
+            if previous is not None:
+                predecessors.add(previous)
+            self._key_tails[key] = done
+
+        self._in_flight += 1
+        try:
+            for previous in predecessors:
+                await previous
+            await handler(payload)
+        finally:
+            self._in_flight -= 1
+            done.set_result(None)
+            for key in keys:
+                if self._key_tails.get(key) is done:
+                    del self._key_tails[key]
+            self.command_metrics.record(
+                topic.rsplit("/", 1)[-1],
+                time.perf_counter() - message.get("received_at", time.perf_counter()),
+            )
 
     async def _monitor_connection(self):
         """Monitor MQTT connection and reconnect if needed"""
@@ -146,7 +311,7 @@ class MQTTBroker:
                     await asyncio.sleep(delay)
 
                     if self.running:  # Check if still running after sleep
-                        if self._connect_internal():
+                        if await self._connect_internal():
                             delay = self._reconnect_delay  # Reset delay on success
                         else:
                             delay = min(delay * 2, self._max_reconnect_delay)
@@ -158,39 +323,294 @@ class MQTTBroker:
                 logger.error(f"Connection monitor error: {e}")
                 await asyncio.sleep(delay)
 
-    def _connect_internal(self):
-        """Internal connection method"""
+    def _on_loop(self, callback, *args):
+        """Run callback on the event loop, right away when already on it"""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # Socket callbacks, called from the loop or from the connecting thread.
+    # Sockets are passed on by descriptor, which stays valid after paho closes
+    # the socket object.
+    def _on_socket_open(self, client, userdata, sock):
+        self._on_loop(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_reader, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock.fileno())
+
+    async def _run_misc(self):
+        """
+        Keepalive pings and QoS retries, the part of paho's loop without I/O.
+        Also resumes an outbox drain that stopped partway, or messages
+        buffered while connected, which no new on_connect would send.
+        """
+        while self.running:
+            await asyncio.sleep(self.MISC_INTERVAL)
+            try:
+                self.client.loop_misc()
+            except Exception as e:
+                logger.error(f"MQTT client loop error: {e}")
+
+            if self.connected and self.outbox.pending:
+                try:
+                    await self.outbox.drain(self._send)
+                except Exception as e:
+                    logger.error(f"Error draining outbox: {e}")
+
+    async def _connect_internal(self):
+        """
+        Internal connection method. DNS lookup and TCP connect block, so they
+        run in a worker thread; the socket is then served by the event loop.
+        """
         try:
-            self.client.connect(self.broker, self.port, 60)
+            await asyncio.to_thread(self.client.connect, self.broker, self.port, 60)
             return True
         except Exception as e:
             logger.error(f"Failed to connect to MQTT broker: {e}")
             return False
 
-    async def _handle_get_transactions(self):
+    @staticmethod
+    def _parse_time(value):
+        """Epoch seconds from a number or an ISO 8601 string"""
+        if value is None:
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        return datetime.fromisoformat(value).timestamp()
+
+    @staticmethod
+    def _record_timestamp(record):
+        """Epoch seconds of a sale or transaction record"""
+        if "timestamp" in record:
+            return record["timestamp"]
+        try:
+            return datetime.strptime(
+                f"{record['date']} {record['time']}", "%a %d %B %Y %H:%M:%S"
+            ).timestamp()
+        except (KeyError, ValueError):
+            return None
+
+    async def _dumps(self, response, records=0, key=None, encoding="json"):
+        """
+        Encode a response as JSON, with the records under key in the requested
+        encoding. Runs in a worker thread when the response carries many
+        records so the serial loop keeps its POLL deadline.
+        """
+        if records >= self.OFFLOAD_MIN_RECORDS:
+            return await asyncio.to_thread(encode_response, response, key, encoding)
+        return encode_response(response, key, encoding)
+
+    @staticmethod
+    def _requested_encoding(payload):
+        """Record encoding asked for in a request, json by default"""
+        encoding = payload.get("encoding") or "json"
+        if encoding not in ENCODINGS:
+            raise ValueError(f"encoding must be one of {', '.join(ENCODINGS)}")
+        return encoding
+
+    async def _iter_records(self, table, cursor, since, until, statuses):
+        """Yield records after cursor that match the filters, page by page"""
+        while True:
+            # Journal reads decode JSON too, keep them off the loop as well
+            documents = await asyncio.to_thread(
+                table.page, after=cursor, limit=self.PAGE_SIZE
+            )
+            if not documents:
+                return
+
+            for document in documents:
+                cursor = document.doc_id
+                if statuses and document.get("status") not in statuses:
+                    continue
+                if since is not None or until is not None:
+                    timestamp = self._record_timestamp(document)
+                    if timestamp is None:
+                        continue
+                    if since is not None and timestamp < since:
+                        continue
+                    if until is not None and timestamp > until:
+                        continue
+                yield document
+
+    async def _handle_get_records(self, table, key, topic, payload):
+        """
+        Publish records matching the request filters in chunks.
+
+        Supported request fields: since / until (epoch seconds or ISO 8601),
+        status (string or list), cursor (id of the last record already
+        received), limit (maximum records for this request) and encoding (one
+        of ENCODINGS, named back in content-encoding). Every chunk
+        carries next_cursor, which continues the listing after that chunk when
+        sent back as cursor; it is null on the last chunk once nothing is left.
+        """
+        payload = payload if isinstance(payload, dict) else {}
+        request_id = payload.get("request_id")
+
+        try:
+            since = self._parse_time(payload.get("since"))
+            until = self._parse_time(payload.get("until"))
+            cursor = int(payload.get("cursor") or 0)
+            limit = int(payload.get("limit") or self.DEFAULT_RECORD_LIMIT)
+            encoding = self._requested_encoding(payload)
+            statuses = payload.get("status")
+            if isinstance(statuses, str):
+                statuses = [statuses]
+            if limit <= 0:
+                raise ValueError("limit must be positive")
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid {key} request: {e}")
+            self._publish(
+                topic,
+                json.dumps(
+                    {"success": False, "error": str(e), "request_id": request_id}
+                ),
+            )
+            return
+
+        async def publish(records, chunk, last, next_cursor):
+            response = {
+                "success": True,
+                key: records,
+                "chunk": chunk,
+                "last": last,
+                "next_cursor": next_cursor,
+            }
+            if request_id is not None:
+                response["request_id"] = request_id
+            self._publish(
+                topic, await self._dumps(response, len(records), key, encoding)
+            )
+
+        records = []
+        chunk = 0
+        sent = 0
+        last_id = cursor
+        next_cursor = None
+        async for document in self._iter_records(table, cursor, since, until, statuses):
+            if sent == limit:
+                next_cursor = last_id
+                break
+
+            if len(records) == self.PAGE_SIZE:
+                await publish(records, chunk, False, last_id)
+                records = []
+                chunk += 1
+
+            records.append({"id": document.doc_id, **document})
+            sent += 1
+            last_id = document.doc_id
+
+        await publish(records, chunk, True, next_cursor)
+
+    async def _handle_get_transactions(self, payload=None):
         """Handle get transactions request"""
-        transactions_data = Transaction.all()
-        response = {
-            "success": True,
-            "transactions": transactions_data,
-        }
-        self.client.publish(
-            f"vmc/{self.machine_id}/transactions_update_status", json.dumps(response)
+        await self._handle_get_records(
+            Transaction,
+            "transactions",
+            f"vmc/{self.machine_id}/transactions_update_status",
+            payload,
         )
-        return response
 
-
-    async def _handle_get_sales(self):
+    async def _handle_get_sales(self, payload=None):
         """Handle get sales request"""
-        sales_data = Sales.all()
-        response = {
-            "success": True,
-            "sales": sales_data,
-        }
-        self.client.publish(
-            f"vmc/{self.machine_id}/sales_update_status", json.dumps(response)
+        await self._handle_get_records(
+            Sales,
+            "sales",
+            f"vmc/{self.machine_id}/sales_update_status",
+            payload,
         )
-        return response
+
+    def _on_record_written(self, stream, doc_id, document):
+        """Journal listener, runs on the persistence thread"""
+        self.loop.call_soon_threadsafe(self._push_records, stream, [document])
+
+    def _push_records(self, stream, documents):
+        """
+        Publish records of a sync stream, tagged with their sequence number.
+        Not buffered in the outbox: unacknowledged records stay in the journal
+        and are pushed again on reconnect.
+        """
+        if not self.connected or not documents:
+            return
+
+        self._send(
+            f"vmc/{self.machine_id}/{stream}_sync",
+            json.dumps(self._sync_message(stream, documents)),
+            qos=1,
+        )
+
+    @staticmethod
+    def _sync_message(stream, documents):
+        return {
+            "stream": stream,
+            "records": [{"seq": document.doc_id, **document} for document in documents],
+            "last_seq": documents[-1].doc_id,
+        }
+
+    async def _handle_sync(self, payload):
+        """
+        Push the records of every stream after the given sequence number.
+
+        The payload maps a stream name to the last sequence the backend holds,
+        e.g. {"sales": 120}; streams left out are pushed from the oldest record
+        that has not been acknowledged. Sent on connect with an empty payload
+        and by the backend when it detects a gap.
+        """
+        payload = payload if isinstance(payload, dict) else {}
+        for stream, table in self._sync_streams.items():
+            try:
+                cursor = int(payload.get(stream) or 0)
+            except (TypeError, ValueError):
+                logger.error(f"Invalid sync cursor for {stream}: {payload.get(stream)}")
+                continue
+
+            while self.connected:
+                documents = await asyncio.to_thread(
+                    table.page, after=cursor, limit=self.PAGE_SIZE
+                )
+                if not documents:
+                    break
+                message = await self._dumps(
+                    self._sync_message(stream, documents), len(documents)
+                )
+                self._send(f"vmc/{self.machine_id}/{stream}_sync", message, qos=1)
+                cursor = documents[-1].doc_id
+
+    async def _handle_sync_ack(self, payload):
+        """
+        Archive records the backend has stored.
+
+        The payload maps a stream name to the highest sequence number received
+        without gaps, e.g. {"sales": 120, "transactions": 40}. Acknowledged
+        records move to the local archive file and are no longer pushed.
+        """
+        if not isinstance(payload, dict):
+            logger.error(f"Invalid sync acknowledgement: {payload}")
+            return
+
+        for stream, table in self._sync_streams.items():
+            if stream not in payload:
+                continue
+            try:
+                up_to = int(payload[stream])
+            except (TypeError, ValueError):
+                logger.error(
+                    f"Invalid sync acknowledgement for {stream}: {payload[stream]}"
+                )
+                continue
+            persistence.submit(table.archive, up_to)
 
     async def _handle_price_update(self, payload):
         """Handle price update messages from MQTT with connection checks"""
@@ -199,10 +619,6 @@ class MQTTBroker:
                 logger.error("No vending machine instance available")
                 return
 
-            if not self.connected:
-                logger.warning("Cannot handle price update - MQTT not connected")
-                return
-
             tray_number = payload.get("tray")
             price = payload.get("price")
             selection = payload.get("selection")
@@ -220,12 +636,11 @@ class MQTTBroker:
                     logger.error("Invalid selection: must be between 1 and 100")
                     return
                 # Use upsert instead of update
-                Prices.upsert(
+                Prices.upsert_selection(
+                    selection,
                     {
-                        "selection": selection,
                         "price": price,
                     },
-                    query.selection == selection,
                 )
                 data = selection.to_bytes(2, byteorder="big") + price.to_bytes(
                     4, byteorder="big"
@@ -238,16 +653,10 @@ class MQTTBroker:
             elif tray_number is not None:
                 special_sel = 1000 + tray_number
                 start_selection = tray_number * 10 + 1
-                for i in range(10):
-                    sel = start_selection + i
-                    # Use upsert for each selection in tray
-                    Prices.upsert(
-                        {
-                            "selection": sel,
-                            "price": price,
-                        },
-                        query.selection == sel,
-                    )
+                # Update the whole tray in one database write
+                Prices.bulk_upsert(
+                    {start_selection + i: {"price": price} for i in range(10)}
+                )
                 # Send one command to the vending machine for the tray
                 data = special_sel.to_bytes(2, byteorder="big") + price.to_bytes(
                     4, byteorder="big"
@@ -264,15 +673,8 @@ class MQTTBroker:
 
             elif set_all:
                 special_sel = 0000
-                # Update a local database first
-                for sel in range(1, 101):
-                    Prices.upsert(
-                        {
-                            "selection": sel,
-                            "price": price,
-                        },
-                        query.selection == sel,
-                    )
+                # Update a local database first, in one write
+                Prices.bulk_upsert({sel: {"price": price} for sel in range(1, 101)})
 
                 # Format command for all selections (0000)
                 # Protocol: Command 0x12, special selection (2 bytes) + price (4 bytes)
@@ -290,27 +692,25 @@ class MQTTBroker:
                 )
                 return
 
-            # Publish response only if connected
-            if self.connected:
-                response = {
-                    "success": success,
-                    "tray": tray_number if tray_number is not None else None,
-                    "selection": selection if selection is not None else None,
-                    "price": price,
-                    "results": results,
-                }
-                self.client.publish(
-                    f"vmc/{self.machine_id}/price_update_status", json.dumps(response)
-                )
+            # Publish response
+            response = {
+                "success": success,
+                "tray": tray_number if tray_number is not None else None,
+                "selection": selection if selection is not None else None,
+                "price": price,
+                "results": results,
+            }
+            self._publish(
+                f"vmc/{self.machine_id}/price_update_status", json.dumps(response)
+            )
 
         except Exception as e:
             logger.error(f"Error handling price update: {e}")
-            # Publish error response only if connected
-            if self.connected:
-                self.client.publish(
-                    f"vmc/{self.machine_id}/price_update_status",
-                    json.dumps({"success": False, "error": str(e)}),
-                )
+            # Publish error response
+            self._publish(
+                f"vmc/{self.machine_id}/price_update_status",
+                json.dumps({"success": False, "error": str(e)}),
+            )
 
     async def _handle_inventory_update(self, payload):
         """Handle inventory update messages from MQTT"""
@@ -319,10 +719,6 @@ class MQTTBroker:
                 logger.error("No vending machine instance available")
                 return
 
-            if not self.connected:
-                logger.warning("Cannot handle inventory update - MQTT not connected")
-                return
-
             tray_number = payload.get("tray")
             inventory = payload.get("inventory")
             product_name = payload.get("product_name")
@@ -345,13 +741,12 @@ class MQTTBroker:
                     logger.error("Invalid selection: must be between 1 and 100")
                     return
                 # Use upsert instead of update
-                Prices.upsert(
+                Prices.upsert_selection(
+                    selection,
                     {
-                        "selection": selection,
                         "product_name": product_name,
                         "inventory": inventory,
                     },
-                    query.selection == selection,
                 )
                 # Send command to vending machine
                 data = selection.to_bytes(2, byteorder="big") + inventory.to_bytes(
@@ -368,15 +763,8 @@ class MQTTBroker:
                 special_sel = 1000 + tray_number
                 # Update all selections in local DB for this tray
                 start_selection = tray_number * 10 + 1
-                for i in range(10):
-                    sel = start_selection + i
-                    Prices.upsert(
-                        {
-                            "inventory": inventory,
-                            "product_name": product_name,
-                        },
-                        query.selection == sel,
-                    )
+                fields = {"inventory": inventory, "product_name": product_name}
+                Prices.bulk_upsert({start_selection + i: fields for i in range(10)})
                 # Send one command to vending machine for the tray
                 data = special_sel.to_bytes(2, byteorder="big") + inventory.to_bytes(
                     1, byteorder="big", signed=False
@@ -395,13 +783,9 @@ class MQTTBroker:
 
             elif set_all:
                 # Use special selection 0000 for all selections
-                for sel in range(1, 101):
-                    Prices.upsert(
-                        {
-                            "inventory": inventory,
-                        },
-                        query.selection == sel,
-                    )
+                Prices.bulk_upsert(
+                    {sel: {"inventory": inventory} for sel in range(1, 101)}
+                )
                 # Send command with special selection 0000
                 data = (0).to_bytes(2, byteorder="big") + inventory.to_bytes(
                     1, byteorder="big", signed=False
@@ -420,27 +804,25 @@ class MQTTBroker:
                 )
                 return
 
-            # Publish response only if connected
-            if self.connected:
-                response = {
-                    "success": success,
-                    "tray": tray_number if tray_number is not None else None,
-                    "selection": selection if selection is not None else None,
-                    "inventory": inventory,
-                    "results": results,
-                }
-                self.client.publish(
-                    f"vmc/{self.machine_id}/inventory_update_status",
-                    json.dumps(response),
-                )
+            # Publish response
+            response = {
+                "success": success,
+                "tray": tray_number if tray_number is not None else None,
+                "selection": selection if selection is not None else None,
+                "inventory": inventory,
+                "results": results,
+            }
+            self._publish(
+                f"vmc/{self.machine_id}/inventory_update_status",
+                json.dumps(response),
+            )
 
         except Exception as e:
             logger.error(f"Error handling inventory update: {e}")
-            if self.connected:
-                self.client.publish(
-                    f"vmc/{self.machine_id}/inventory_update_status",
-                    json.dumps({"success": False, "error": str(e)}),
-                )
+            self._publish(
+                f"vmc/{self.machine_id}/inventory_update_status",
+                json.dumps({"success": False, "error": str(e)}),
+            )
 
     async def _handle_capacity_update(self, payload):
         """Handle capacity update messages from MQTT"""
@@ -449,10 +831,6 @@ class MQTTBroker:
                 logger.error("No vending machine instance available")
                 return
 
-            if not self.connected:
-                logger.warning("Cannot handle capacity update - MQTT not connected")
-                return
-
             tray_number = payload.get("tray")
             capacity = payload.get("capacity")
             selection = payload.get("selection")
@@ -475,7 +853,7 @@ class MQTTBroker:
                     logger.error("Invalid selection: must be between 1 and 100")
                     return
                 # Update local DB
-                Prices.update({"capacity": capacity}, query.selection == selection)
+                Prices.update_selection(selection, {"capacity": capacity})
                 # Send command to vending machine
                 data = selection.to_bytes(2, byteorder="big") + capacity.to_bytes(
                     1, byteorder="big", signed=False
@@ -491,9 +869,9 @@ class MQTTBroker:
                 special_sel = 1000 + tray_number
                 # Update all selections in local DB for this tray
                 start_selection = tray_number * 10 + 1
-                for i in range(10):
-                    sel = start_selection + i
-                    Prices.update({"capacity": capacity}, query.selection == sel)
+                Prices.bulk_update(
+                    {start_selection + i: {"capacity": capacity} for i in range(10)}
+                )
                 # Send one command to vending machine for the tray
                 data = special_sel.to_bytes(2, byteorder="big") + capacity.to_bytes(
                     1, byteorder="big", signed=False
@@ -512,8 +890,9 @@ class MQTTBroker:
 
             elif set_all:
                 # Use special selection 0000 for all selections
-                for sel in range(1, 101):
-                    Prices.update({"capacity": capacity}, query.selection == sel)
+                Prices.bulk_update(
+                    {sel: {"capacity": capacity} for sel in range(1, 101)}
+                )
                 # Send command with special selection 0000
                 data = (0).to_bytes(2, byteorder="big") + capacity.to_bytes(
                     1, byteorder="big", signed=False
@@ -536,62 +915,204 @@ class MQTTBroker:
                 )
                 return
 
-            # Publish response only if connected
-            if self.connected:
-                response = {
-                    "success": success,
-                    "tray": tray_number if tray_number is not None else None,
-                    "selection": selection if selection is not None else None,
-                    "capacity": capacity,
-                    "results": results,
-                }
-                self.client.publish(
-                    f"vmc/{self.machine_id}/capacity_update_status",
-                    json.dumps(response),
-                )
+            # Publish response
+            response = {
+                "success": success,
+                "tray": tray_number if tray_number is not None else None,
+                "selection": selection if selection is not None else None,
+                "capacity": capacity,
+                "results": results,
+            }
+            self._publish(
+                f"vmc/{self.machine_id}/capacity_update_status",
+                json.dumps(response),
+            )
 
         except Exception as e:
             logger.error(f"Error handling capacity update: {e}")
-            if self.connected:
-                self.client.publish(
-                    f"vmc/{self.machine_id}/capacity_update_status",
-                    json.dumps(
-                        {
-                            "success": False,
-                            "error": str(e),
-                        }
-                    ),
-                )
-
-    async def _handle_get_prices(self):
-        """Handle get price request"""
+            self._publish(
+                f"vmc/{self.machine_id}/capacity_update_status",
+                json.dumps(
+                    {
+                        "success": False,
+                        "error": str(e),
+                    }
+                ),
+            )
+
+    # Batch operation type -> (VMC command, value field, value size in bytes)
+    BATCH_OPERATIONS = {
+        "price": ("SET_PRICE", "price", 4),
+        "inventory": ("SET_INVENTORY", "inventory", 1),
+        "capacity": ("SET_CAPACITY", "capacity", 1),
+    }
+
+    def _validate_operation(self, operation):
+        """Error message for an invalid batch operation, None if it is valid"""
+        if not isinstance(operation, dict):
+            return "operation must be an object"
+        if operation.get("type") not in self.BATCH_OPERATIONS:
+            return f"type must be one of {', '.join(self.BATCH_OPERATIONS)}"
+
+        _, field, size = self.BATCH_OPERATIONS[operation["type"]]
+        value = operation.get(field)
+        if not isinstance(value, int) or not (0 <= value < 256**size):
+            return f"{field} must be an integer between 0 and {256**size - 1}"
+
+        selection = operation.get("selection")
+        tray = operation.get("tray")
+        if selection is not None:
+            if not isinstance(selection, int) or not (1 <= selection <= 100):
+                return "selection must be between 1 and 100"
+        elif tray is not None:
+            if not isinstance(tray, int) or not (0 <= tray <= 9):
+                return "tray must be between 0 and 9"
+        elif not operation.get("all"):
+            return "no selection, tray or all flag provided"
+        return None
+
+    async def _handle_batch(self, payload):
+        """
+        Handle a batch of price, inventory and capacity updates.
+
+        The payload carries "operations", a list of objects with a "type" of
+        price, inventory or capacity, the value under the field of the same
+        name (plus an optional product_name for inventory) and a selection,
+        tray or all flag like the single update topics. Valid operations are
+        written to the database together in one write and sent to the VMC in
+        order; a single response lists the result of every operation.
+        """
+        topic = f"vmc/{self.machine_id}/batch_status"
         try:
-            # Query all price records from a database
-            all_prices = Prices.all()
+            if not self.vending_machine:
+                logger.error("No vending machine instance available")
+                return
 
-            # Format the response
-            prices_list = []
-            for price in all_prices:
-                prices_list.append(
+            request_id = payload.get("request_id")
+            operations = payload.get("operations")
+            if not isinstance(operations, list) or not operations:
+                raise ValueError("operations must be a non-empty list")
+
+            results = []
+            valid = []
+            upserts = {}
+            updates = {}
+            for index, operation in enumerate(operations):
+                error = self._validate_operation(operation)
+                if error:
+                    results.append({"index": index, "success": False, "error": error})
+                    continue
+
+                _, field, _ = self.BATCH_OPERATIONS[operation["type"]]
+                fields = {field: operation[field]}
+                if operation["type"] == "inventory" and "product_name" in operation:
+                    fields["product_name"] = operation["product_name"]
+
+                # Capacity only applies to configured selections, as in set_capacity
+                changes = updates if operation["type"] == "capacity" else upserts
+                for selection in self._target_selections(operation):
+                    changes.setdefault(selection, {}).update(fields)
+                valid.append((index, operation))
+
+            # Single database write for the whole batch
+            Prices.apply(upserts=upserts, updates=updates)
+
+            for index, operation in valid:
+                command, field, size = self.BATCH_OPERATIONS[operation["type"]]
+                if operation.get("selection") is not None:
+                    special_sel = operation["selection"]
+                elif operation.get("tray") is not None:
+                    special_sel = 1000 + operation["tray"]
+                else:
+                    special_sel = 0
+                value = operation[field]
+                data = special_sel.to_bytes(2, byteorder="big") + value.to_bytes(
+                    size, byteorder="big"
+                )
+                vm_result = await self.vending_machine.queue_command(command, data)
+                results.append(
                     {
-                        "selection": price.get("selection"),
-                        "price": price.get("price"),
-                        "product_name": price.get("product_name"),
-                        "inventory": price.get("inventory"),
-                        "capacity": price.get("capacity"),
-                    },
+                        "index": index,
+                        "type": operation["type"],
+                        "special_selection": special_sel,
+                        "success": vm_result,
+                    }
                 )
 
+            results.sort(key=lambda result: result["index"])
+            succeeded = sum(1 for result in results if result["success"])
+            response = {
+                "success": succeeded == len(results),
+                "request_id": request_id,
+                "applied": succeeded,
+                "failed": len(results) - succeeded,
+                "results": results,
+            }
+            self._publish(topic, await self._dumps(response, len(results)))
+
+        except Exception as e:
+            logger.error(f"Error handling batch update: {e}")
+            self._publish(topic, json.dumps({"success": False, "error": str(e)}))
+
+    @staticmethod
+    def _format_prices(prices):
+        return [
+            {
+                "selection": price.get("selection"),
+                "price": price.get("price"),
+                "product_name": price.get("product_name"),
+                "inventory": price.get("inventory"),
+                "capacity": price.get("capacity"),
+            }
+            for price in prices
+        ]
+
+    async def _handle_get_prices(self, payload=None):
+        """
+        Handle get price request, payload may ask for an encoding.
+
+        Every reply carries the table version. A request with if_version set
+        to a version received earlier gets not_modified when nothing changed
+        since, or with delta set only the selections that changed.
+        """
+        try:
+            payload = payload or {}
+            encoding = self._requested_encoding(payload)
+            version = Prices.version
+
+            delta = None
+            if payload.get("if_version") is not None:
+                if payload["if_version"] == version:
+                    self._publish(
+                        f"vmc/{self.machine_id}/prices",
+                        json.dumps(
+                            {"success": True, "not_modified": True, "version": version}
+                        ),
+                    )
+                    return
+                delta = Prices.changes_since(payload["if_version"])
+
+            # Query changed or all price records from a database
+            all_prices = delta if delta is not None else Prices.all()
+
+            # Format the response
+            prices_list = self._format_prices(all_prices)
+
             # Publish response
             response = {
                 "success": True,
+                "version": version,
+                "delta": delta is not None,
                 "prices": prices_list,
             }
-            self.client.publish(f"vmc/{self.machine_id}/prices", json.dumps(response))
+            self._publish(
+                f"vmc/{self.machine_id}/prices",
+                await self._dumps(response, len(prices_list), "prices", encoding),
+            )
 
         except Exception as e:
             logger.error(f"Error handling get prices request: {e}")
-            self.client.publish(
+            self._publish(
                 f"vmc/{self.machine_id}/prices",
                 json.dumps(
                     {
@@ -601,6 +1122,83 @@ class MQTTBroker:
                 ),
             )
 
+    async def _handle_set_stock(self, payload):
+        """
+        Handle stock update messages from MQTT.
+
+        The payload is {"product_name": ..., "quantity": ...} or a list of
+        those under "items"; products that do not exist yet are created.
+        """
+        try:
+            items = payload.get("items", [payload])
+            results = []
+            for item in items:
+                product_name = item.get("product_name")
+                quantity = item.get("quantity")
+                if not product_name or not isinstance(quantity, int) or quantity < 0:
+                    logger.error(f"Invalid stock item: {item}")
+                    results.append({"product_name": product_name, "success": False})
+                    continue
+
+                persistence.submit(
+                    Stock.upsert,
+                    {"product_name": product_name, "quantity": quantity},
+                    query.product_name == product_name,
+                )
+                results.append(
+                    {
+                        "product_name": product_name,
+                        "quantity": quantity,
+                        "success": True,
+                    }
+                )
+
+            response = {
+                "success": all(result["success"] for result in results),
+                "results": results,
+            }
+            self._publish(
+                f"vmc/{self.machine_id}/stock_update_status", json.dumps(response)
+            )
+
+        except Exception as e:
+            logger.error(f"Error handling stock update: {e}")
+            self._publish(
+                f"vmc/{self.machine_id}/stock_update_status",
+                json.dumps({"success": False, "error": str(e)}),
+            )
+
+    @staticmethod
+    def _read_stock():
+        """All stock documents, consistent with queued writes (worker thread)"""
+        with persistence.lock:
+            return Stock.all()
+
+    async def _handle_get_stock(self, payload=None):
+        """Handle get stock request"""
+        try:
+            # The lock can be held through a journal fsync, wait off the loop
+            all_stock = await asyncio.to_thread(self._read_stock)
+
+            response = {
+                "success": True,
+                "stock": [
+                    {
+                        "product_name": stock.get("product_name"),
+                        "quantity": stock.get("quantity"),
+                    }
+                    for stock in all_stock
+                ],
+            }
+            self._publish(f"vmc/{self.machine_id}/stock", json.dumps(response))
+
+        except Exception as e:
+            logger.error(f"Error handling get stock request: {e}")
+            self._publish(
+                f"vmc/{self.machine_id}/stock",
+                json.dumps({"success": False, "error": str(e)}),
+            )
+
     async def _handle_ping(self, payload):
         """Handle ping messages and respond with pong"""
         try:
@@ -619,11 +1217,11 @@ class MQTTBroker:
                         response[key] = value
 
             # Publish the response
-            self.client.publish(f"vmc/{self.machine_id}/pong", json.dumps(response))
+            self._publish(f"vmc/{self.machine_id}/pong", json.dumps(response))
 
         except Exception as e:
             logger.error(f"Error handling ping: {e}")
-            self.client.publish(
+            self._publish(
                 f"vmc/{self.machine_id}/pong",
                 json.dumps(
                     {
@@ -633,9 +1231,100 @@ class MQTTBroker:
                 ),
             )
 
-    def connect(self):
+    async def _publish_metrics(self):
+        """Periodically publish poll latency statistics"""
+        while self.running:
+            try:
+                await asyncio.sleep(self.METRICS_INTERVAL)
+
+                if not self.connected or not self.vending_machine:
+                    continue
+
+                response = {
+                    "machine_id": self.machine_id,
+                    "date": datetime.now().strftime("%a %d %B %Y"),
+                    "time": datetime.now().strftime("%H:%M:%S"),
+                    "poll": self.vending_machine.poll_metrics.snapshot(reset=True),
+                    "commands": {
+                        "queue_depth": self.message_queue.qsize(),
+                        "in_flight": self._in_flight,
+                        **self.command_metrics.snapshot(reset=True),
+                    },
+                }
+                self._publish(f"vmc/{self.machine_id}/metrics", json.dumps(response))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error publishing metrics: {e}")
+
+    def _health(self):
+        """Current machine health, as published in the health snapshot"""
+        vm = self.vending_machine
+        if not vm:
+            return {"vending_machine": False}
+        return {
+            "vending_machine": True,
+            "state": vm.state,
+            "serial_connected": vm.serial_connected,
+            "payment_connected": vm.esocket_connected,
+            "machine_status": vm.machine_status,
+            "machine_status_detail": vm.machine_status_detail,
+            "outbox": len(self.outbox),
+        }
+
+    async def _update_snapshot(self, name, key, build):
+        """Publish a retained snapshot when its key changed since the last one"""
+        if self._snapshot_keys.get(name) == key:
+            return
+
+        response = {
+            "machine_id": self.machine_id,
+            "timestamp": int(time.time()),
+            **build(),
+        }
+        records = len(response.get("prices", ()))
+        payload = await self._dumps(response, records)
+        if self._send(
+            f"vmc/{self.machine_id}/snapshot/{name}", payload, qos=1, retain=True
+        ):
+            self._snapshot_keys[name] = key
+
+    async def _publish_snapshots(self):
+        """
+        Keep retained prices and health snapshots on the broker up to date.
+
+        Changes are coalesced over SNAPSHOT_INTERVAL, so dashboards read the
+        latest state from the broker without a round trip to the machine.
+        Snapshots are skipped while disconnected; whatever changed meanwhile
+        is published after reconnecting.
+        """
+        while self.running:
+            try:
+                await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+                if not self.connected:
+                    continue
+
+                version = Prices.version
+                await self._update_snapshot(
+                    "prices",
+                    version,
+                    lambda: {
+                        "version": version,
+                        "prices": self._format_prices(Prices.all()),
+                    },
+                )
+                health = self._health()
+                await self._update_snapshot(
+                    "health", json.dumps(health, sort_keys=True), lambda: health
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error publishing snapshots: {e}")
+
+    async def connect(self):
         """Connect to MQTT broker"""
-        return self._connect_internal()
+        return await self._connect_internal()
 
     async def start(self):
         """Start broker operations"""
@@ -644,14 +1333,30 @@ class MQTTBroker:
         # Start connection monitoring
         self._connection_monitor_task = asyncio.create_task(self._monitor_connection())
 
-        # Start MQTT client
-        self.client.loop_start()
+        # Start publishing poll latency metrics
+        self._metrics_task = asyncio.create_task(self._publish_metrics())
+
+        # Start pushing state change events
+        self._telemetry_task = asyncio.create_task(self.telemetry.run())
+
+        # Start keeping retained snapshots current
+        self._snapshot_task = asyncio.create_task(self._publish_snapshots())
+
+        # Start MQTT client housekeeping, socket I/O is driven by the loop
+        self._misc_task = asyncio.create_task(self._run_misc())
 
         # Start processing messages
         await self.process_messages()
 
     async def stop(self):
         """Stop broker operations"""
+        # A clean disconnect does not fire the last will, mark offline here
+        self._send(
+            f"vmc/{self.machine_id}/status",
+            json.dumps({"online": False}),
+            qos=1,
+            retain=True,
+        )
         self.running = False
         self.connected = False
 
@@ -663,7 +1368,36 @@ class MQTTBroker:
             except asyncio.CancelledError:
                 pass
 
-        # Stop MQTT client
-        self.client.loop_stop()
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            try:
+                await self._metrics_task
+            except asyncio.CancelledError:
+                pass
+
+        # Pending events are flushed to the outbox on the way out
+        if self._telemetry_task:
+            self._telemetry_task.cancel()
+            try:
+                await self._telemetry_task
+            except asyncio.CancelledError:
+                pass
+
+        if self._snapshot_task:
+            self._snapshot_task.cancel()
+            try:
+                await self._snapshot_task
+            except asyncio.CancelledError:
+                pass
+
+        if self._misc_task:
+            self._misc_task.cancel()
+            try:
+                await self._misc_task
+            except asyncio.CancelledError:
+                pass
+
+        # Stop MQTT client, writing the DISCONNECT packet out right away
         self.client.disconnect()
+        self.client.loop_write()
         logger.info("MQTT broker stopped")
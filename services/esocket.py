@@ -1,13 +1,237 @@
 import asyncio
+import functools
 import json
 import os
 import struct
 import time
 import xml.etree.ElementTree as ET
-from typing import Dict, Any
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+ESP_NAMESPACE = "http://www.mosaicsoftware.com/Postilion/eSocket.POS/"
+
+# Characters ElementTree escapes in attribute values
+_ATTRIBUTE_ESCAPES = str.maketrans(
+    {
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "\n": "&#10;",
+        "\r": "&#13;",
+        "\t": "&#09;",
+    }
+)
+
+
+class ESocketTimeout(Exception):
+    """No response arrived for a request that must not be resent"""
+
+
+def create_message_header(message_length: int) -> bytes:
+    """Create TCP message header based on length"""
+    if message_length < 65535:
+        return struct.pack("BB", message_length // 256, message_length % 256)
+    return b"\xff\xff" + struct.pack(">I", message_length)
+
+
+class MessageTemplate:
+    """
+    eSocket request compiled into byte fragments.
+
+    The XML declaration, the Esp:Interface envelope and every fixed attribute
+    are encoded once; rendering only escapes and encodes the variable
+    attribute values and joins the length header and body in one buffer.
+    The output matches ElementTree's serialization of the same request.
+    """
+
+    def __init__(self, element: str, attributes, children=()):
+        """
+        attributes is a sequence of (name, value) in document order, where a
+        value of None marks a field filled in by render(). children is a
+        sequence of (element, attributes) with fixed values only, written
+        inside the element.
+        """
+        self.element = element
+        self._parts = []  # constant bytes, or the name of a field
+        self.fields = set()
+        constant = (
+            f'{XML_DECLARATION}<Esp:Interface Version="1.0" '
+            f'xmlns:Esp="{ESP_NAMESPACE}"><{element}'
+        )
+        for name, value in attributes:
+            if value is None:
+                self._parts.append(constant.encode())
+                self._parts.append(name)
+                self.fields.add(name)
+                constant = ""
+            else:
+                constant += f' {name}="{str(value).translate(_ATTRIBUTE_ESCAPES)}"'
+        if children:
+            constant += ">"
+            for child, child_attributes in children:
+                constant += f"<{child}"
+                for name, value in child_attributes:
+                    constant += f' {name}="{str(value).translate(_ATTRIBUTE_ESCAPES)}"'
+                constant += " />"
+            constant += f"</{element}>"
+        else:
+            constant += " />"
+        self._parts.append(f"{constant}</Esp:Interface>".encode())
+
+    def render(self, **values) -> bytes:
+        """
+        Length header and message body in a single buffer. Fields set to None
+        are left out of the message.
+        """
+        chunks = []
+        for part in self._parts:
+            if isinstance(part, bytes):
+                chunks.append(part)
+                continue
+            value = values[part]
+            if value is not None:
+                escaped = str(value).translate(_ATTRIBUTE_ESCAPES)
+                chunks.append(f' {part}="{escaped}"'.encode())
+
+        length = sum(len(chunk) for chunk in chunks)
+        return b"".join([create_message_header(length), *chunks])
+
+
+@dataclass
+class ESocketResponse:
+    """Fields of an eSocket response, see parse_response()"""
+
+    raw_response: str
+    element: Optional[str] = None  # Transaction, Admin, Error, Event, ...
+    action_code: Optional[str] = None
+    response_code: Optional[str] = None
+    message_reason_code: Optional[str] = None
+    error_message: Optional[str] = None
+    transaction_id: Optional[str] = None
+    event_id: Optional[str] = None  # Event and Callback messages
+    event_data: Optional[str] = None
+    error: Optional[str] = None  # set when the XML could not be parsed
+
+    @property
+    def success(self) -> bool:
+        return self.error is None and self.action_code == "APPROVE"
+
+
+# Response attributes -> ESocketResponse fields
+_RESPONSE_FIELDS = {
+    "ActionCode": "action_code",
+    "ResponseCode": "response_code",
+    "MessageReasonCode": "message_reason_code",
+    "ErrorMessage": "error_message",
+    "TransactionId": "transaction_id",
+    "EventId": "event_id",
+    "EventData": "event_data",
+}
+
+
+def parse_response(response: str) -> ESocketResponse:
+    """
+    Parse an eSocket response in a single pass over its start tags.
+
+    element is the local name of the message inside Esp:Interface. Each
+    field takes the first value found for its attribute in document order,
+    so attribute order and quoting style do not matter.
+    """
+    result = ESocketResponse(raw_response=response)
+    parser = ET.XMLPullParser(events=("start",))
+    remaining = len(_RESPONSE_FIELDS)
+    try:
+        parser.feed(response)
+        parser.close()
+    except ET.ParseError as e:
+        result.error = str(e)
+
+    try:
+        # Events parsed before any error are still delivered
+        for _, element in parser.read_events():
+            local_name = element.tag.rpartition("}")[2].rpartition(":")[2]
+            if result.element is None and local_name != "Interface":
+                result.element = local_name
+
+            for attribute, field in _RESPONSE_FIELDS.items():
+                value = element.get(attribute)
+                if value is not None and getattr(result, field) is None:
+                    setattr(result, field, value)
+                    remaining -= 1
+            if remaining == 0 and result.element is not None:
+                break
+    except ET.ParseError as e:
+        result.error = str(e)
+    return result
+
+
+# Events registered at INIT, see docs/payment.md section 12.2
+EVENT_IDS = (
+    "PROMPT_INSERT_CARD",
+    "PROMPT_SWIPE_CARD",
+    "PROMPT_CONFIRM_TRAN",
+    "PROMPT_PIN",
+    "PROMPT_TRANSACTION_PROCESSING",
+    "PROMPT_TRANSACTION_OUTCOME",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def init_template(callback_ids=()) -> MessageTemplate:
+    """
+    INIT request registering for EVENT_IDS and the given callbacks. eSocket
+    waits for the answer to every registered callback, so only callbacks
+    with a handler are registered.
+    """
+    return MessageTemplate(
+        "Esp:Admin",
+        [("TerminalId", None), ("Action", "INIT")],
+        children=[
+            *(
+                ("Esp:Register", [("Type", "EVENT"), ("EventId", event_id)])
+                for event_id in EVENT_IDS
+            ),
+            *(
+                ("Esp:Register", [("Type", "CALLBACK"), ("EventId", event_id)])
+                for event_id in callback_ids
+            ),
+        ],
+    )
+
+
+ADMIN_TEMPLATE = MessageTemplate("Esp:Admin", [("TerminalId", None), ("Action", None)])
+CALLBACK_TEMPLATE = MessageTemplate(
+    "Esp:Callback",
+    [("TerminalId", None), ("EventId", None), ("ResponseData", None)],
+)
+PURCHASE_TEMPLATE = MessageTemplate(
+    "Esp:Transaction",
+    [
+        ("TerminalId", None),
+        ("TransactionId", None),
+        ("Type", "PURCHASE"),
+        ("TransactionAmount", None),
+        ("CurrencyCode", None),
+    ],
+)
+REVERSAL_TEMPLATE = MessageTemplate(
+    "Esp:Transaction",
+    [
+        ("TerminalId", None),
+        ("TransactionId", None),
+        ("Type", "REVERSAL"),
+        ("OriginalTransactionId", None),
+        ("ReasonCode", None),
+    ],
+)
 
 
 class ESocketClient:
+    # Seconds to wait for the response to a request
+    RESPONSE_TIMEOUT = 200.0
+
     def __init__(self, host: str = "127.0.0.1", port: int = 23001):
         self.host = host
         self.port = port
@@ -18,6 +242,26 @@ class ESocketClient:
         self._last_activity = 0
         self._reconnect_delay = 5  # seconds
         self._max_reconnect_delay = 60  # seconds
+        self._reader_task = None
+        # Futures of requests awaiting a response, keyed by TransactionId or
+        # by element name for messages without one (Esp:Admin)
+        self._pending = {}
+        # Callbacks receiving eSocket events, see add_listener()
+        self._listeners = []
+        # EventId -> handler answering callbacks, see set_callback_handler()
+        self._callback_handlers = {}
+
+    def add_listener(self, callback):
+        """Call callback(event_id, event_data) for every Esp:Event received"""
+        self._listeners.append(callback)
+
+    def set_callback_handler(self, event_id: str, handler):
+        """
+        Answer Esp:Callback messages for event_id with handler(event_data),
+        which returns the ResponseData or a coroutine producing it. Only
+        callbacks with a handler are registered, from the next INIT on.
+        """
+        self._callback_handlers[event_id] = handler
 
     def _load_terminal_id(self):
         """Load terminal ID from config file"""
@@ -41,6 +285,7 @@ class ESocketClient:
             )
             self.is_connected = True
             self._last_activity = time.time()
+            self._reader_task = asyncio.create_task(self._read_messages())
             print(f"Connected to eSocket at {self.host}:{self.port}")
             return True
 
@@ -56,6 +301,10 @@ class ESocketClient:
     async def _cleanup_connection(self):
         """Clean up any existing connection"""
         self.is_connected = False
+        reader_task, self._reader_task = self._reader_task, None
+        if reader_task and reader_task is not asyncio.current_task():
+            reader_task.cancel()
+        self._fail_pending(ConnectionError("eSocket connection closed"))
         if self.writer:
             try:
                 self.writer.close()
@@ -65,14 +314,106 @@ class ESocketClient:
         self.writer = None
         self.reader = None
 
+    def _fail_pending(self, error: Exception):
+        """Fail every request still waiting for a response"""
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
     def _create_message_header(self, message_length: int):
         """Create TCP message header based on length"""
-        if message_length < 65535:
-            return struct.pack("BB", message_length // 256, message_length % 256)
-        return b"\xff\xff" + struct.pack(">I", message_length)
+        return create_message_header(message_length)
+
+    async def _read_frame(self) -> str:
+        """Read one length-prefixed message from the socket"""
+        header = await self.reader.readexactly(2)
+        if header == b"\xff\xff":
+            length = struct.unpack(">I", await self.reader.readexactly(4))[0]
+        else:
+            length = header[0] * 256 + header[1]
+        data = await self.reader.readexactly(length)
+        return data.decode("utf-8")
+
+    async def _read_messages(self):
+        """
+        Read messages for the lifetime of the connection. eSocket interleaves
+        events and callbacks with responses on the same socket, so every
+        message is read here and routed by _dispatch().
+        """
+        try:
+            while True:
+                message = self._parse_response(await self._read_frame())
+                self._last_activity = time.time()
+                self._dispatch(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"eSocket connection lost: {e}")
+            await self._cleanup_connection()
+
+    def _dispatch(self, message: ESocketResponse):
+        """Route a message to event listeners, a callback or its request"""
+        if message.element == "Event":
+            for callback in self._listeners:
+                try:
+                    callback(message.event_id, message.event_data or "")
+                except Exception as e:
+                    print(f"eSocket event listener failed: {e}")
+            return
+
+        if message.element == "Callback":
+            asyncio.create_task(self._answer_callback(message))
+            return
+
+        future = self._pending.pop(message.transaction_id or message.element, None)
+        if future is None and message.element == "Error" and len(self._pending) == 1:
+            # Errors for requests that could not be parsed carry no TransactionId
+            future = self._pending.popitem()[1]
+        if future is None:
+            print(f"Unmatched eSocket response: {message.raw_response}")
+        elif not future.done():
+            future.set_result(message)
+
+    async def _answer_callback(self, message: ESocketResponse):
+        """Send the ResponseData for a callback, empty if there is none"""
+        response_data = ""
+        handler = self._callback_handlers.get(message.event_id)
+        if handler is not None:
+            try:
+                response_data = handler(message.event_data or "")
+                if asyncio.iscoroutine(response_data):
+                    response_data = await response_data
+            except Exception as e:
+                print(f"eSocket callback {message.event_id} failed: {e}")
+                response_data = ""
 
-    async def _send_message(self, xml_message: str):
-        """Send XML message and receive response with connection handling"""
+        if not self.writer:
+            return
+        try:
+            self.writer.write(
+                CALLBACK_TEMPLATE.render(
+                    TerminalId=self.terminal_id,
+                    EventId=message.event_id,
+                    ResponseData=response_data or "",
+                )
+            )
+            await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"Failed to answer eSocket callback {message.event_id}: {e}")
+
+    async def _send_message(
+        self, message: bytes, key: str, repeat: bool = True, on_sent=None
+    ) -> ESocketResponse:
+        """
+        Send a framed message (header and XML body, see MessageTemplate) and
+        wait for the response matching key, its TransactionId or element name.
+
+        Messages with repeat set are sent again when no response arrives.
+        Otherwise a lost response raises ESocketTimeout once the message was
+        written, since eSocket may already have processed it. on_sent() is
+        called as soon as the message is handed to the socket.
+        """
         max_retries = 3
         retry_count = 0
 
@@ -85,38 +426,24 @@ class ESocketClient:
                 else:
                     raise Exception("Failed to establish connection after retries")
 
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
             try:
-                # Prepare and send message
-                message_bytes = xml_message.encode("utf-8")
-                header = self._create_message_header(len(message_bytes))
-                self.writer.write(header + message_bytes)
+                # Send message
+                self.writer.write(message)
+                if on_sent is not None:
+                    on_sent()
                 await self.writer.drain()
                 self._last_activity = time.time()
 
-                # Read response header with 120s timeout
-                response_header = await asyncio.wait_for(
-                    self.reader.readexactly(2), timeout=200.0
-                )
-
-                # Determine message length
-                if response_header == b"\xff\xff":
-                    length_bytes = await asyncio.wait_for(
-                        self.reader.readexactly(4), timeout=200.0
-                    )
-                    response_length = struct.unpack(">I", length_bytes)[0]
-                else:
-                    response_length = response_header[0] * 256 + response_header[1]
-
-                # Read response body with 120s timeout
-                response_data = await asyncio.wait_for(
-                    self.reader.readexactly(response_length), timeout=200.0
-                )
-                self._last_activity = time.time()
-                return response_data.decode("utf-8")
+                # The reader task resolves the future when the response arrives
+                return await asyncio.wait_for(future, timeout=self.RESPONSE_TIMEOUT)
 
             except (asyncio.TimeoutError, ConnectionError, OSError) as e:
                 print(f"Communication error: {e}")
                 await self._cleanup_connection()
+                if not repeat:
+                    raise ESocketTimeout(f"No response to {key}") from e
                 retry_count += 1
                 if retry_count < max_retries:
                     print(f"Retrying connection ({retry_count}/{max_retries})...")
@@ -128,6 +455,9 @@ class ESocketClient:
             except Exception as e:
                 await self._cleanup_connection()
                 raise Exception(f"Communication error: {e}")
+            finally:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
 
     async def initialize_terminal(self, terminal_id: str = None):
         """Initialize terminal session"""
@@ -137,27 +467,9 @@ class ESocketClient:
 
             self.terminal_id = terminal_id
 
-            root = ET.Element(
-                "Esp:Interface",
-                {
-                    "Version": "1.0",
-                    "xmlns:Esp": "http://www.mosaicsoftware.com/Postilion/eSocket.POS/",
-                },
-            )
-
-            ET.SubElement(
-                root,
-                "Esp:Admin",
-                {
-                    "TerminalId": terminal_id,
-                    "Action": "INIT",
-                },
-            )
-
-            xml_message = f'<?xml version="1.0" encoding="UTF-8"?>\n{ET.tostring(root, encoding="unicode")}'
-            response = await self._send_message(xml_message)
-
-            return self._parse_response(response)
+            template = init_template(tuple(sorted(self._callback_handlers)))
+            message = template.render(TerminalId=terminal_id)
+            return await self._send_message(message, "Admin")
         except Exception as e:
             raise Exception(f"Terminal initialization failed: {e}")
 
@@ -167,30 +479,10 @@ class ESocketClient:
             return {"success": True, "message": "Already disconnected"}
 
         try:
-            root = ET.Element(
-                "Esp:Interface",
-                {
-                    "Version": "1.0",
-                    "xmlns:Esp": "http://www.mosaicsoftware.com/Postilion/eSocket.POS/",
-                },
-            )
-
-            ET.SubElement(
-                root,
-                "Esp:Admin",
-                {
-                    "TerminalId": self.terminal_id,
-                    "Action": "CLOSE",
-                },
-            )
+            message = ADMIN_TEMPLATE.render(TerminalId=self.terminal_id, Action="CLOSE")
+            parsed = await self._send_message(message, "Admin")
 
-            xml_message = f'<?xml version="1.0" encoding="UTF-8"?>\n{ET.tostring(root, encoding="unicode")}'
-            response = await self._send_message(xml_message)
-            parsed = self._parse_response(response)
-
-            if parsed.get("success") and 'ActionCode="APPROVE"' in parsed.get(
-                "raw_response", ""
-            ):
+            if parsed.success:
                 await self._cleanup_connection()
                 return parsed
             raise Exception("Terminal close failed")
@@ -199,33 +491,30 @@ class ESocketClient:
             raise Exception(f"Failed to close terminal: {e}")
 
     async def send_purchase_transaction(
-        self, transaction_id: str, amount: int, currency_code: str = "840"
+        self,
+        transaction_id: str,
+        amount: int,
+        currency_code: str = "840",
+        on_sent=None,
     ):
-        """Send purchase transaction"""
+        """
+        Send purchase transaction. A purchase is never resent: when its
+        response is lost ESocketTimeout is raised and the purchase has to be
+        reversed, see docs/payment.md section 10. on_sent() is called once
+        the request went out, from then on abandoning it needs a reversal.
+        """
         try:
-            root = ET.Element(
-                "Esp:Interface",
-                {
-                    "Version": "1.0",
-                    "xmlns:Esp": "http://www.mosaicsoftware.com/Postilion/eSocket.POS/",
-                },
+            message = PURCHASE_TEMPLATE.render(
+                TerminalId=self.terminal_id,
+                TransactionId=transaction_id,
+                TransactionAmount=amount,
+                CurrencyCode=currency_code,
             )
-
-            ET.SubElement(
-                root,
-                "Esp:Transaction",
-                {
-                    "TerminalId": self.terminal_id,
-                    "TransactionId": transaction_id,
-                    "Type": "PURCHASE",
-                    "TransactionAmount": str(amount),
-                    "CurrencyCode": currency_code,
-                },
+            return await self._send_message(
+                message, transaction_id, repeat=False, on_sent=on_sent
             )
-
-            xml_message = f'<?xml version="1.0" encoding="UTF-8"?>\n{ET.tostring(root, encoding="unicode")}'
-            response = await self._send_message(xml_message)
-            return self._parse_response(response)
+        except ESocketTimeout:
+            raise
         except Exception as e:
             raise Exception(f"Purchase transaction failed: {e}")
 
@@ -234,43 +523,16 @@ class ESocketClient:
     ):
         """Send reversal transaction"""
         try:
-            root = ET.Element(
-                "Esp:Interface",
-                {
-                    "Version": "1.0",
-                    "xmlns:Esp": "http://www.mosaicsoftware.com/Postilion/eSocket.POS/",
-                },
+            message = REVERSAL_TEMPLATE.render(
+                TerminalId=self.terminal_id,
+                TransactionId=transaction_id,
+                OriginalTransactionId=original_transaction_id,
+                ReasonCode=reason_code or None,
             )
-
-            reversal_attrs = {
-                "TerminalId": self.terminal_id,
-                "TransactionId": transaction_id,
-                "Type": "REVERSAL",
-                "OriginalTransactionId": original_transaction_id,
-            }
-
-            if reason_code:
-                reversal_attrs["ReasonCode"] = reason_code
-
-            ET.SubElement(root, "Esp:Transaction", reversal_attrs)
-
-            xml_message = f'<?xml version="1.0" encoding="UTF-8"?>\n{ET.tostring(root, encoding="unicode")}'
-            response = await self._send_message(xml_message)
-            return self._parse_response(response)
+            return await self._send_message(message, transaction_id)
         except Exception as e:
             raise Exception(f"Reversal transaction failed: {e}")
 
-    def _parse_response(self, response: str):
+    def _parse_response(self, response: str) -> ESocketResponse:
         """Parse XML response from eSocket"""
-        try:
-            root = ET.fromstring(response)
-            return {
-                "raw_response": response,
-                "success": 'ActionCode="APPROVE"' in response,
-            }
-        except Exception as e:
-            return {
-                "raw_response": response,
-                "success": False,
-                "error": str(e),
-            }
+        return parse_response(response)
@@ -3,9 +3,10 @@ import json
 import os
 import struct
 import time
-import xml.etree.ElementTree as ET
 from typing import Dict, Any
 
+from services.esocket import ESocketResponse, parse_response
+
 
 class ESocketClient:
     def __init__(self, host: str = "127.0.0.1", port: int = 23001):
@@ -18,6 +19,24 @@ class ESocketClient:
         self._last_activity = 0
         self._reconnect_delay = 5  # seconds
         self._max_reconnect_delay = 60  # seconds
+        self._listeners = []
+        self._callback_handlers = {}
+
+    def add_listener(self, callback):
+        """Call callback(event_id, event_data) for every simulated event"""
+        self._listeners.append(callback)
+
+    def set_callback_handler(self, event_id: str, handler):
+        """Kept for interface parity, the simulator sends no callbacks"""
+        self._callback_handlers[event_id] = handler
+
+    def _send_event(self, event_id: str, event_data: str = ""):
+        """Simulate an Esp:Event from eSocket"""
+        for callback in self._listeners:
+            try:
+                callback(event_id, event_data)
+            except Exception as e:
+                print(f"eSocket event listener failed: {e}")
 
     def _load_terminal_id(self):
         """Load terminal ID from config file"""
@@ -57,16 +76,16 @@ class ESocketClient:
             return struct.pack("BB", message_length // 256, message_length % 256)
         return b"\xff\xff" + struct.pack(">I", message_length)
 
-    async def _send_message(self, xml_message: str):
+    async def _send_message(self, message: bytes, key: str) -> ESocketResponse:
         """Simulate sending XML message and receiving response"""
         # Simulate a delay
         await asyncio.sleep(0.1)
         # Always return a simulated approved response
-        simulated_response = '''<?xml version="1.0" encoding="UTF-8"?>
+        simulated_response = """<?xml version="1.0" encoding="UTF-8"?>
 <Esp:Interface Version="1.0" xmlns:Esp="http://www.mosaicsoftware.com/Postilion/eSocket.POS/">
     <Esp:Response ActionCode="APPROVE" />
-</Esp:Interface>'''
-        return simulated_response
+</Esp:Interface>"""
+        return self._parse_response(simulated_response)
 
     async def initialize_terminal(self, terminal_id: str = None):
         """Simulate initialize terminal session"""
@@ -77,8 +96,7 @@ class ESocketClient:
             self.terminal_id = terminal_id
 
             # Simulate success
-            response = await self._send_message("")
-            return self._parse_response(response)
+            return await self._send_message(b"", "Admin")
         except Exception as e:
             raise Exception(f"Terminal initialization failed: {e}")
 
@@ -88,10 +106,9 @@ class ESocketClient:
             return {"success": True, "message": "Already disconnected"}
 
         try:
-            response = await self._send_message("")
-            parsed = self._parse_response(response)
+            parsed = await self._send_message(b"", "Admin")
 
-            if parsed.get("success"):
+            if parsed.success:
                 await self._cleanup_connection()
                 return parsed
             raise Exception("Terminal close failed")
@@ -100,16 +117,26 @@ class ESocketClient:
             raise Exception(f"Failed to close terminal: {e}")
 
     async def send_purchase_transaction(
-        self, transaction_id: str, amount: int, currency_code: str = "840"
+        self,
+        transaction_id: str,
+        amount: int,
+        currency_code: str = "840",
+        on_sent=None,
     ):
         """Simulate send purchase transaction"""
         try:
-            # Simulate payment processing with 5 second delay
-            await asyncio.sleep(5)
+            if on_sent is not None:
+                on_sent()
+            # Simulate the card prompts of a 5 second payment
+            self._send_event("PROMPT_INSERT_CARD")
+            await asyncio.sleep(2)
+            self._send_event("PROMPT_PIN")
+            await asyncio.sleep(3)
 
             # Always approve
-            response = await self._send_message("")
-            return self._parse_response(response)
+            response = await self._send_message(b"", transaction_id)
+            self._send_event("PROMPT_TRANSACTION_OUTCOME", "APPROVE")
+            return response
         except Exception as e:
             raise Exception(f"Purchase transaction failed: {e}")
 
@@ -122,22 +149,10 @@ class ESocketClient:
             await asyncio.sleep(1)
 
             # Always approve
-            response = await self._send_message("")
-            return self._parse_response(response)
+            return await self._send_message(b"", transaction_id)
         except Exception as e:
             raise Exception(f"Reversal transaction failed: {e}")
 
-    def _parse_response(self, response: str):
+    def _parse_response(self, response: str) -> ESocketResponse:
         """Parse XML response from eSocket"""
-        try:
-            root = ET.fromstring(response)
-            return {
-                "raw_response": response,
-                "success": 'ActionCode="APPROVE"' in response,
-            }
-        except Exception as e:
-            return {
-                "raw_response": response,
-                "success": False,
-                "error": str(e),
-            }
+        return parse_response(response)
@@ -0,0 +1,110 @@
+import asyncio
+
+from utils import broker_logger as logger
+
+
+class MessageOutbox:
+    """
+    Disk-backed buffer for MQTT publishes made while the link is down.
+
+    Messages are appended to a journal table, so they survive a restart, and
+    are drained in publish order once the broker is reachable again. The
+    outbox holds at most MAX_MESSAGES; when it is full the oldest message is
+    dropped to make room. Appends go through the persistence worker, so
+    buffering a message never touches the disk from the event loop.
+    """
+
+    MAX_MESSAGES = 5000
+    DRAIN_BATCH = 100
+
+    def __init__(self, table, persistence):
+        self._table = table
+        self._persistence = persistence
+        self._last_id = table.last_id()
+        self._sent_id = 0  # highest id published, its removal may still be queued
+        self._draining = False
+        # Messages handed to put() and those appended by the persistence
+        # worker, each counter is only written by one thread
+        self._put_count = 0
+        self._written_count = 0
+
+    @property
+    def pending(self):
+        """True while buffered messages have not been published"""
+        return self._written_count < self._put_count or self._last_id > self._sent_id
+
+    def __len__(self):
+        return len(self._table)
+
+    def put(self, topic, payload, qos=0, retain=False):
+        """Buffer a message until the next drain"""
+        self._put_count += 1
+        self._persistence.submit(
+            self._append,
+            {"topic": topic, "payload": payload, "qos": qos, "retain": retain},
+        )
+
+    def _append(self, message):
+        """Write a buffered message, runs on the persistence worker"""
+        if len(self._table) >= self.MAX_MESSAGES:
+            oldest = self._table.page(after=self._sent_id, limit=1)
+            if oldest:
+                self._table.remove(doc_ids=[oldest[0].doc_id])
+                logger.warning(f"Outbox full, dropped message for {oldest[0]['topic']}")
+
+        self._last_id = self._table.insert(message)
+        self._written_count += 1
+
+    async def drain(self, publish):
+        """
+        Publish buffered messages in batches through publish(topic, payload,
+        qos, retain), which returns False when the message could not be sent.
+        Returns True once the outbox is empty.
+        """
+        if self._draining:
+            return False
+
+        self._draining = True
+        drained = 0
+        try:
+            while self.pending:
+                # Read in this order: once every put() is written, _last_id
+                # is final and covers everything page() can return
+                written, last_id = self._written_count, self._last_id
+                documents = self._table.page(
+                    after=self._sent_id, limit=self.DRAIN_BATCH
+                )
+                if not documents:
+                    if written < self._put_count:
+                        # Messages still on their way to the journal
+                        return False
+                    # The rest was dropped while the outbox was full
+                    self._sent_id = max(self._sent_id, last_id)
+                    break
+
+                sent = []
+                for document in documents:
+                    if not publish(
+                        document["topic"],
+                        document["payload"],
+                        document.get("qos", 0),
+                        document.get("retain", False),
+                    ):
+                        break
+                    sent.append(document.doc_id)
+
+                if sent:
+                    self._sent_id = sent[-1]
+                    drained += len(sent)
+                    self._persistence.submit(self._table.remove, doc_ids=sent)
+                if len(sent) < len(documents):
+                    return False
+
+                # Let the serial loop run between batches
+                await asyncio.sleep(0)
+
+            return True
+        finally:
+            self._draining = False
+            if drained:
+                logger.info(f"Published {drained} buffered messages")
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+from utils import vending_logger as logger
+
+
+class ReversalQueue:
+    """
+    Disk-backed queue of eSocket reversals.
+
+    A purchase whose response was lost may still have been charged, so it is
+    reversed instead of resent (docs/payment.md section 10). A reversal
+    carries the TransactionId of the purchase it reverses (section 12.3).
+    Reversals are appended to a journal table by the persistence worker, so
+    they survive a restart, and run() sends them oldest first. A reversal is
+    itself a repeat message: the same request is sent again, with
+    exponential backoff, until eSocket answers it.
+    """
+
+    RETRY_DELAY = 5  # seconds
+    MAX_RETRY_DELAY = 300  # seconds
+
+    def __init__(self, table, persistence, client):
+        self._table = table
+        self._persistence = persistence
+        self._client = client
+        self._done_id = 0  # highest id acknowledged, its removal may still be queued
+        self._wakeup = asyncio.Event()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(entry, response) once eSocket has answered a reversal"""
+        self._listeners.append(callback)
+
+    def __len__(self):
+        return len(self._table)
+
+    def put(self, transaction_id, reason_code=None, details=None):
+        """
+        Queue a reversal of the purchase transaction_id, must run on the loop.
+        details is kept with the entry for listeners, see add_listener().
+        """
+        entry = {
+            "transaction_id": transaction_id,
+            "reason_code": reason_code,
+            "details": details or {},
+            "attempts": 0,
+            "timestamp": int(time.time()),
+        }
+        self._persistence.submit(self._append, entry, asyncio.get_running_loop())
+        logger.info(f"Queued reversal of transaction {transaction_id}")
+
+    def _append(self, entry, loop):
+        """Write a reversal and wake run(), runs on the persistence worker"""
+        self._table.insert(entry)
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _send(self, entry):
+        """Send one reversal, returns True once eSocket has answered it"""
+        if not self._client.is_connected:
+            return False
+
+        attempts = entry.get("attempts", 0) + 1
+        self._persistence.submit(
+            self._table.update, {"attempts": attempts}, doc_ids=[entry.doc_id]
+        )
+        try:
+            response = await self._client.send_reversal_transaction(
+                transaction_id=entry["transaction_id"],
+                original_transaction_id=entry["transaction_id"],
+                reason_code=entry.get("reason_code"),
+            )
+        except Exception as e:
+            logger.warning(
+                f"Reversal of transaction {entry['transaction_id']} not sent: {e}"
+            )
+            return False
+
+        # Esp:Error means the request was not processed, e.g. before INIT
+        if response.error is not None or response.element == "Error":
+            logger.warning(
+                f"Reversal of transaction {entry['transaction_id']} rejected: "
+                f"{response.error or response.response_code}"
+            )
+            return False
+
+        if response.success:
+            logger.info(f"Reversal of transaction {entry['transaction_id']} approved")
+        else:
+            logger.error(
+                f"Reversal of transaction {entry['transaction_id']} declined: "
+                f"{response.action_code} {response.response_code}"
+            )
+        self._done_id = entry.doc_id
+        self._persistence.submit(self._table.remove, doc_ids=[entry.doc_id])
+        for callback in self._listeners:
+            try:
+                callback(entry, response)
+            except Exception as e:
+                logger.error(f"Reversal listener failed: {e}")
+        return True
+
+    async def run(self):
+        """Send queued reversals until cancelled"""
+        delay = self.RETRY_DELAY
+        while True:
+            pending = self._table.page(after=self._done_id, limit=1)
+            if not pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            try:
+                sent = await self._send(pending[0])
+            except Exception as e:
+                logger.error(f"Error sending reversal: {e}")
+                sent = False
+
+            if sent:
+                delay = self.RETRY_DELAY
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
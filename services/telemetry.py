@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+from utils import broker_logger as logger
+
+
+class TelemetryPublisher:
+    """
+    Collects machine events and publishes them in coalesced batches.
+
+    Events recorded within one interval go out together in a single message.
+    State transitions and dispenses are sent in full; for inventory levels
+    and connection status only the latest value per selection or link is
+    kept, since earlier ones are already out of date.
+    """
+
+    # Events where only the latest value per key matters
+    LATEST_ONLY = {"inventory": "selection", "connection": "link"}
+
+    def __init__(self, publish, topic, interval=1.0):
+        self._publish = publish
+        self.topic = topic
+        self.interval = interval
+        self._events = []
+        self._latest = {}  # (event, key) -> position in _events
+        self._pending = asyncio.Event()
+
+    def record(self, event):
+        """Queue an event for the next batch, must run on the event loop"""
+        key_field = self.LATEST_ONLY.get(event["event"])
+        if key_field is not None:
+            key = (event["event"], event.get(key_field))
+            position = self._latest.get(key)
+            if position is not None:
+                self._events[position] = event
+                return
+            self._latest[key] = len(self._events)
+
+        self._events.append(event)
+        self._pending.set()
+
+    def flush(self):
+        """Publish queued events now"""
+        if not self._events:
+            return
+
+        events, self._events, self._latest = self._events, [], {}
+        self._pending.clear()
+        self._publish(self.topic, json.dumps({"events": events}))
+
+    async def run(self):
+        """Publish batches until cancelled"""
+        try:
+            while True:
+                await self._pending.wait()
+                # Collect whatever else happens within the interval
+                await asyncio.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Error publishing telemetry: {e}")
+        finally:
+            self.flush()
@@ -9,11 +9,36 @@ from datetime import datetime
 
 import serial_asyncio
 
-from db import Prices, Sales, query, Transaction
-from services.esocket import ESocketClient
-from utils import VMC_COMMANDS
+from db import Prices, Reversals, Sales, Transaction, persistence
+from services.esocket import ESocketClient, ESocketTimeout
+from services.reversals import ReversalQueue
+from utils import (
+    VMC_COMMANDS,
+    MENU_COMMAND_TYPES,
+    ACK_PACKETS,
+    FrameParser,
+    PollLatencyTracker,
+    encode_packet,
+)
 from utils import vending_logger as logger
 
+# Command codes resolved once at import, keeping name lookups off the hot path
+POLL = VMC_COMMANDS["POLL"]["code"]
+SELECTION_STATUS = VMC_COMMANDS["SELECTION_STATUS"]["code"]
+DISPENSING_STATUS = VMC_COMMANDS["DISPENSING_STATUS"]["code"]
+SELECT_CANCEL = VMC_COMMANDS["SELECT_CANCEL"]["code"]
+SELECTION_INFO = VMC_COMMANDS["SELECTION_INFO"]["code"]
+MONEY_NOTICE = VMC_COMMANDS["MONEY_NOTICE"]["code"]
+CURRENT_AMOUNT = VMC_COMMANDS["CURRENT_AMOUNT"]["code"]
+DISPLAY_REQUEST = VMC_COMMANDS["DISPLAY_REQUEST"]["code"]
+MACHINE_STATUS_DETAIL = VMC_COMMANDS["MACHINE_STATUS_DETAIL"]["code"]
+MACHINE_STATUS_RESP = VMC_COMMANDS["MACHINE_STATUS_RESP"]["code"]
+IC_BALANCE_RESP = VMC_COMMANDS["IC_BALANCE_RESP"]["code"]
+CALL_MENU = VMC_COMMANDS["CALL_MENU"]["code"]
+MICROWAVE_INFO = VMC_COMMANDS["MICROWAVE_INFO"]["code"]
+MENU_RESPONSE = VMC_COMMANDS["MENU_RESPONSE"]["code"]
+QUERY_SELECTION_CONFIG = MENU_COMMAND_TYPES["QUERY_SELECTION_CONFIG"]
+
 
 class VendingMachine:
 
@@ -28,6 +53,11 @@ class VendingMachine:
             config = json.load(config_file)
 
         self.machine_id = config["MACHINE_ID"]
+        # Callbacks receiving state change events, see add_listener()
+        self._listeners = []
+        self._state = "idle"
+        self._serial_connected = False
+        self._esocket_connected = False
         self.port = port
         self.debug = debug
         self.STX = bytes([0xFA, 0xFB])
@@ -41,23 +71,168 @@ class VendingMachine:
         self.MAX_RETRIES = 5
         self.last_command_time = 0
         self.esocket_client = ESocketClient()
-        self.esocket_connected = False
+        self.esocket_client.add_listener(self._on_payment_event)
+        self.reversals = ReversalQueue(Reversals, persistence, self.esocket_client)
+        self.reversals.add_listener(self._on_reversal_done)
+        self._reversal_task = None
         self._last_cancel_packet = None
-        self.recv_buffer = bytearray()
+        self.parser = FrameParser()
+        self.poll_metrics = PollLatencyTracker(self.RESPONSE_TIMEOUT)
+        self._received_at = 0
         self.event_queue = asyncio.Queue()
         self._payment_lock = asyncio.Lock()
         self._command_semaphore = asyncio.Semaphore(5)
         self._current_transaction_task = None
-        self.state = "idle"
         self._current_transaction_id = None
+        self._paid_at = None  # timestamp of the approved Transaction record
         # Connection monitoring
-        self.serial_connected = False
         self._connection_monitor_task = None
         self._reconnect_delay = 5  # seconds
         self._max_reconnect_delay = 60  # seconds
         self.sale_id = None
         self.current_selection_data = None
         self.amount = None
+        # Latest reports received from the VMC
+        self.selection_info = {}
+        self.selection_status = {}
+        self.selection_config = {}
+        self.machine_status = None
+        self.machine_status_detail = None
+        self.current_amount = None
+        self.last_money_notice = None
+        self.display_text = {}
+        self.ic_balance = None
+        self.microwave_status = None
+        self.last_menu_response = None
+        # Packet handlers keyed by command byte
+        self._packet_handlers = {
+            POLL: self._handle_poll,
+            SELECTION_STATUS: self._handle_selection_status,
+            DISPENSING_STATUS: self._handle_dispensing_status,
+            SELECT_CANCEL: self._handle_selection_cancel,
+            SELECTION_INFO: self._handle_selection_info,
+            MONEY_NOTICE: self._handle_money_notice,
+            CURRENT_AMOUNT: self._handle_current_amount,
+            DISPLAY_REQUEST: self._handle_display_request,
+            MACHINE_STATUS_DETAIL: self._handle_machine_status_detail,
+            MACHINE_STATUS_RESP: self._handle_machine_status,
+            IC_BALANCE_RESP: self._handle_ic_balance,
+            CALL_MENU: self._handle_call_menu,
+            MICROWAVE_INFO: self._handle_microwave_info,
+            MENU_RESPONSE: self._handle_menu_response,
+        }
+
+    def add_listener(self, callback):
+        """
+        Call callback(event) on every state change. event is a dict with the
+        event name under "event", a "ts" timestamp and event specific fields.
+        """
+        self._listeners.append(callback)
+
+    def _emit(self, event, **fields):
+        if not self._listeners:
+            return
+
+        event = {"event": event, "ts": round(time.time(), 3), **fields}
+        for callback in self._listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Event listener failed: {e}")
+
+    def _on_payment_event(self, event_id, event_data):
+        """Forward card prompts from the payment terminal"""
+        logger.info(f"Payment event {event_id}: {event_data}")
+        self._emit("payment", prompt=event_id, data=event_data)
+
+    @staticmethod
+    def _reversal_record(transaction_id, status, details):
+        """
+        Transaction record for a step of a reversal. details names the record
+        being reversed through original_timestamp, since transaction ids are
+        reused, and the failed sale through sale_id where there is one.
+        """
+        return {
+            **details,
+            "transaction_id": transaction_id,
+            "status": status,
+            "date": datetime.now().strftime("%a %d %B %Y"),
+            "time": datetime.now().strftime("%H:%M:%S"),
+            "timestamp": int(time.time()),
+        }
+
+    def _reverse_payment(self, transaction_id, details, status="reversal_pending"):
+        """
+        Queue a reversal of a payment and record it under status. Without an
+        original_timestamp in details, the record written here is the one
+        being reversed, as for a purchase that timed out.
+        """
+        record = self._reversal_record(transaction_id, status, details)
+        details = {"original_timestamp": record["timestamp"], **details}
+        self.reversals.put(transaction_id, details=details)
+        persistence.submit(Transaction.insert, record)
+        self._emit("reversal", transaction_id=transaction_id, status="pending")
+
+    async def _send_purchase(self, transaction_id, amount, details):
+        """
+        Send a purchase. When it is cancelled after the request went out,
+        eSocket may still approve it with nobody waiting for the answer, so
+        it is reversed before the cancellation propagates.
+        """
+        sent = False
+
+        def mark_sent():
+            nonlocal sent
+            sent = True
+
+        try:
+            return await self.esocket_client.send_purchase_transaction(
+                transaction_id=transaction_id, amount=amount, on_sent=mark_sent
+            )
+        except asyncio.CancelledError:
+            if sent:
+                logger.warning(f"Payment {transaction_id} cancelled, reversing")
+                self._reverse_payment(transaction_id, details, status="cancelled")
+            raise
+
+    def _on_reversal_done(self, entry, response):
+        """Record the outcome of a reversal as a new Transaction record"""
+        status = "reversed" if response.success else "reversal_declined"
+        transaction_id = entry["transaction_id"]
+        record = self._reversal_record(transaction_id, status, entry.get("details", {}))
+        record["response_code"] = response.response_code
+        persistence.submit(Transaction.insert, record)
+        self._emit("reversal", transaction_id=transaction_id, status=status)
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        previous, self._state = self._state, value
+        if previous != value:
+            self._emit("state", previous=previous, state=value)
+
+    @property
+    def serial_connected(self):
+        return self._serial_connected
+
+    @serial_connected.setter
+    def serial_connected(self, value):
+        previous, self._serial_connected = self._serial_connected, value
+        if previous != value:
+            self._emit("connection", link="serial", up=value)
+
+    @property
+    def esocket_connected(self):
+        return self._esocket_connected
+
+    @esocket_connected.setter
+    def esocket_connected(self, value):
+        previous, self._esocket_connected = self._esocket_connected, value
+        if previous != value:
+            self._emit("connection", link="payment", up=value)
 
     def log(self, *args):
         """Legacy log method that now uses the centralized logger"""
@@ -80,6 +255,10 @@ class VendingMachine:
         await self._connect_serial()
         await self._connect_payment_terminal()
 
+        # Send reversals left over from before a restart, and new ones
+        if not self._reversal_task:
+            self._reversal_task = asyncio.create_task(self.reversals.run())
+
         # Start communication and event handling
         asyncio.create_task(self._communication_loop())
 
@@ -199,6 +378,10 @@ class VendingMachine:
             except asyncio.CancelledError:
                 pass
 
+        if self._reversal_task:
+            self._reversal_task.cancel()
+            self._reversal_task = None
+
         # Close serial connection
         await self._cleanup_serial()
         self.serial_connected = False
@@ -214,23 +397,8 @@ class VendingMachine:
 
         logger.info("Shutdown complete")
 
-    @staticmethod
-    def _calculate_xor(data):
-        xor_value = 0
-        for b in data:
-            xor_value ^= b
-        return xor_value
-
     def create_packet(self, command, data=None):
-        packet = self.STX + bytes([command])
-
-        if data:
-            packet += bytes([len(data) + 1])
-            packet += bytes([self.packet_number]) + data
-        else:
-            packet += bytes([1]) + bytes([self.packet_number])
-
-        packet += bytes([self._calculate_xor(packet)])
+        packet = encode_packet(command, self.packet_number, data)
         self.packet_number = (self.packet_number % 255) + 1
         return packet
 
@@ -240,10 +408,24 @@ class VendingMachine:
             logger.warning("Cannot send command: serial not connected")
             return False
 
+        return await self._write_packet(self.create_packet(command, data))
+
+    async def _send_ack(self):
+        """Send the prebuilt ACK for the current packet number"""
+        if not self.serial_connected or not self.writer:
+            logger.warning("Cannot send command: serial not connected")
+            return False
+
+        packet = ACK_PACKETS[self.packet_number]
+        self.packet_number = (self.packet_number % 255) + 1
+        return await self._write_packet(packet)
+
+    async def _write_packet(self, packet):
+        """Write a complete packet to the serial port"""
         try:
-            packet = self.create_packet(command, data)
             self.writer.write(packet)
             await self.writer.drain()
+            self.poll_metrics.reply_sent(time.perf_counter())
 
             self.last_command_time = time.time()
             return True
@@ -262,7 +444,8 @@ class VendingMachine:
 
                 data = await asyncio.wait_for(self.reader.read(1024), timeout=1.0)
                 if data:
-                    self.recv_buffer.extend(data)
+                    self._received_at = time.perf_counter()
+                    self.parser.feed(data)
                     await self._process_incoming_data()
 
             except asyncio.TimeoutError:
@@ -274,42 +457,9 @@ class VendingMachine:
                 await asyncio.sleep(0.1)
 
     async def _process_incoming_data(self):
-        """Process all available data in buffer"""
-        while len(self.recv_buffer) >= 5:  # Minimum packet size
-            packet, remaining = self._extract_packet(self.recv_buffer)
-            if not packet:
-                break
-
+        """Process all complete packets in the parser buffer"""
+        for packet in self.parser.packets():
             await self._handle_packet(packet)
-            self.recv_buffer = remaining
-
-    def _extract_packet(self, data):
-        """Extract a complete packet from raw data"""
-        stx_pos = data.find(self.STX)
-        if stx_pos == -1:
-            return None, data
-
-        data = data[stx_pos:]  # Skip bytes before STX
-
-        if len(data) < 5:  # Minimum packet size
-            return None, data
-
-        cmd = data[2]
-        length = data[3]
-        packet_end = 4 + length + 1  # Header + data + checksum
-
-        if len(data) < packet_end:
-            return None, data
-
-        packet = data[:packet_end]
-        remaining = data[packet_end:]
-
-        # Verify checksum
-        if self._calculate_xor(packet[:-1]) != packet[-1]:
-            logger.warning(f"Invalid checksum in packet: {packet.hex(' ')}")
-            return None, data[2:]  # Skip bad STX and resync
-
-        return packet, remaining
 
     async def _handle_packet(self, packet):
         """Handle a single validated packet"""
@@ -320,31 +470,34 @@ class VendingMachine:
         if len(payload) > 0:
             self.packet_number = payload[0]
 
-        if cmd == VMC_COMMANDS["POLL"]["code"]:
-            await self._handle_poll()
-        elif cmd == VMC_COMMANDS["SELECTION_INFO"]["code"]:
-            await self._handle_selection_info(payload)
-        elif cmd == VMC_COMMANDS["DISPENSING_STATUS"]["code"]:
-            await self._handle_dispensing_status(payload)
-        elif cmd == VMC_COMMANDS["SELECT_CANCEL"]["code"]:
-            await self._handle_selection_cancel(payload)
+        handler = self._packet_handlers.get(cmd)
+        if handler:
+            await handler(payload)
         else:
-            await self._send_command(VMC_COMMANDS["ACK"]["code"])
+            await self._send_ack()
 
-    async def _handle_poll(self):
-        """Optimized poll handling"""
+    async def _handle_poll(self, payload):
+        """Answer a POLL with the next queued command or an ACK"""
+        self.poll_metrics.poll_received(self._received_at)
         if not self.command_queue.empty():
-            cmd = await self.command_queue.get()
-            # Prioritize dispensing commands
-            if (
-                isinstance(cmd, tuple)
-                and cmd[0] == VMC_COMMANDS["DIRECT_DRIVE"]["code"]
-            ):
-                await self._send_command(*cmd)
-            else:
-                await self._send_command(*cmd if isinstance(cmd, tuple) else (cmd,))
+            cmd = self.command_queue.get_nowait()
+            await self._send_command(*cmd if isinstance(cmd, tuple) else (cmd,))
         else:
-            await self._send_command(VMC_COMMANDS["ACK"]["code"])
+            await self._send_ack()
+
+    async def _handle_selection_status(self, payload):
+        """Handle selection status response (0x02)"""
+        if len(payload) < 4:
+            logger.warning("Invalid SELECTION_STATUS packet")
+            await self._send_ack()
+            return
+
+        status = payload[1]
+        selection = int.from_bytes(payload[2:4], "big")
+        self.selection_status[selection] = status
+        logger.info(f"Selection #{selection} status: 0x{status:02X}")
+
+        await self._send_ack()
 
     async def _handle_selection_info(self, payload):
         """Handle selection info from machine"""
@@ -352,9 +505,170 @@ class VendingMachine:
             logger.warning("Invalid SELECTION_INFO packet")
             return
 
-        logger.info(f"Selection info event received")
+        selection = int.from_bytes(payload[1:3], "big")
+        self.selection_info[selection] = {
+            "price": int.from_bytes(payload[3:7], "big"),
+            "inventory": payload[7],
+            "capacity": payload[8],
+            "product_id": int.from_bytes(payload[9:11], "big"),
+            "paused": payload[11] == 1,
+        }
+        logger.info(f"Selection info event received for selection #{selection}")
+
+        await self._send_ack()
+
+    async def _handle_money_notice(self, payload):
+        """Handle VMC money collection notice (0x21)"""
+        if len(payload) < 6:
+            logger.warning("Invalid MONEY_NOTICE packet")
+            await self._send_ack()
+            return
+
+        self.last_money_notice = {
+            "mode": payload[1],
+            "amount": int.from_bytes(payload[2:6], "big"),
+            "card_number": bytes(payload[6:]).decode("ascii", "replace"),
+        }
+        logger.info(
+            f"Money collected: mode={payload[1]}, amount={self.last_money_notice['amount']}"
+        )
 
-        await self._send_command(VMC_COMMANDS["ACK"]["code"])
+        await self._send_ack()
+
+    async def _handle_current_amount(self, payload):
+        """Handle VMC current amount report (0x23)"""
+        if len(payload) < 5:
+            logger.warning("Invalid CURRENT_AMOUNT packet")
+            await self._send_ack()
+            return
+
+        self.current_amount = int.from_bytes(payload[1:5], "big")
+        logger.info(f"Current amount: {self.current_amount}")
+
+        await self._send_ack()
+
+    async def _handle_display_request(self, payload):
+        """Handle POS display request (0x24)"""
+        if len(payload) < 19:
+            logger.warning("Invalid DISPLAY_REQUEST packet")
+            await self._send_ack()
+            return
+
+        row = payload[18]
+        text = bytes(payload[1:17]).decode("ascii", "replace").rstrip("\x00 ")
+        self.display_text[row] = text
+        logger.info(f"Display request row {row}: {text}")
+
+        await self._send_ack()
+
+    async def _handle_machine_status_detail(self, payload):
+        """Handle machine status detail response (0x52)"""
+        if len(payload) < 14:
+            logger.warning("Invalid MACHINE_STATUS_DETAIL packet")
+            await self._send_ack()
+            return
+
+        self.machine_status_detail = {
+            "bill_acceptor": payload[1],
+            "coin_acceptor": payload[2],
+            "card_reader": payload[3],
+            "temperature_controller": payload[4],
+            "door": payload[5],
+            "bill_change": int.from_bytes(payload[6:10], "big"),
+            "coin_change": int.from_bytes(payload[10:14], "big"),
+            "machine_id": bytes(payload[14:24]).decode("ascii", "replace"),
+            "temperature": bytes(payload[24:32]).decode("ascii", "replace"),
+            "humidity": bytes(payload[32:40]).decode("ascii", "replace"),
+        }
+        logger.info(f"Machine status detail: {self.machine_status_detail}")
+
+        await self._send_ack()
+
+    async def _handle_machine_status(self, payload):
+        """Handle machine status response (0x54)"""
+        if len(payload) < 2:
+            logger.warning("Invalid MACHINE_STATUS_RESP packet")
+            await self._send_ack()
+            return
+
+        self.machine_status = payload[1]
+        logger.info(f"Machine status: 0x{self.machine_status:02X}")
+
+        await self._send_ack()
+
+    async def _handle_ic_balance(self, payload):
+        """Handle IC card balance response (0x62)"""
+        if len(payload) < 6:
+            logger.warning("Invalid IC_BALANCE_RESP packet")
+            await self._send_ack()
+            return
+
+        self.ic_balance = {
+            "status": payload[1],
+            "balance": int.from_bytes(payload[2:6], "big"),
+        }
+        logger.info(f"IC card balance: {self.ic_balance}")
+
+        await self._send_ack()
+
+    async def _handle_call_menu(self, payload):
+        """Handle VMC request to open the menu (0x63)"""
+        logger.info("Menu call received from VMC")
+
+        await self._send_ack()
+
+    async def _handle_microwave_info(self, payload):
+        """Handle microwave info (0x66)"""
+        if len(payload) < 2:
+            logger.warning("Invalid MICROWAVE_INFO packet")
+            await self._send_ack()
+            return
+
+        count = payload[1]
+        self.microwave_status = list(payload[2 : 2 + count])
+        logger.info(f"Microwave info: {count} units, status={self.microwave_status}")
+
+        await self._send_ack()
+
+    async def _handle_menu_response(self, payload):
+        """Handle menu response (0x71)"""
+        if len(payload) < 3:
+            logger.warning("Invalid MENU_RESPONSE packet")
+            await self._send_ack()
+            return
+
+        command_type = payload[1]
+        operation = payload[2]
+        data = bytes(payload[3:])
+        self.last_menu_response = {
+            "command_type": command_type,
+            "operation": operation,
+            "data": data,
+        }
+
+        # Selection configuration query (0x42, operation 0x00)
+        if command_type == QUERY_SELECTION_CONFIG and operation == 0x00:
+            if len(data) >= 13:
+                config = {
+                    "price": int.from_bytes(data[0:4], "big"),
+                    "inventory": int.from_bytes(data[4:6], "big"),
+                    "capacity": data[6],
+                    "product_id": int.from_bytes(data[7:9], "big"),
+                    "selection_mode": data[9],
+                    "drop_sensor": data[10],
+                    "jammed_set": data[11],
+                    "quarter_turn": data[12],
+                }
+                self.selection_config = config
+                logger.info(f"Selection configuration: {config}")
+            else:
+                logger.warning("Invalid selection configuration response")
+        else:
+            logger.info(
+                f"Menu response: type=0x{command_type:02X}, operation=0x{operation:02X}"
+            )
+
+        await self._send_ack()
 
     async def _handle_selection_cancel(self, payload):
         """Handle selection cancel"""
@@ -376,7 +690,7 @@ class VendingMachine:
             and self._last_cancel_packet == packet_number
         ):
             logger.info("Ignoring duplicate cancel packet")
-            await self._send_command(VMC_COMMANDS["ACK"]["code"])
+            await self._send_ack()
             return
 
         self._last_cancel_packet = packet_number
@@ -403,7 +717,7 @@ class VendingMachine:
             # Only process if machine is idle
             if self.state != "idle":
                 logger.info(f"Ignoring selection, machine state is {self.state}")
-                await self._send_command(VMC_COMMANDS["ACK"]["code"])
+                await self._send_ack()
                 return
 
             # Set state to selected and process payment
@@ -413,14 +727,14 @@ class VendingMachine:
             logger.info(f"Selected product #{selection}")
             await self._process_payment(selection)
 
-        await self._send_command(VMC_COMMANDS["ACK"]["code"])
+        await self._send_ack()
 
     async def _process_payment(self, selection):
         """Enhanced payment processing with connection checks"""
         if self._current_transaction_task:
             logger.warning("Payment attempted while transaction in progress")
             if self.serial_connected:
-                await self._send_command(VMC_COMMANDS["ACK"]["code"])
+                await self._send_ack()
             return
 
         if not self.esocket_connected:
@@ -435,7 +749,7 @@ class VendingMachine:
                 logger.info(f"State changed to: {self.state}")
 
                 # get the selection info and set the data in the class
-                selection_data = Prices.get(query.selection == selection)
+                selection_data = Prices.get_selection(selection)
                 amount = selection_data.get("price", 0)
                 self.current_selection_data = selection_data
                 self.amount = amount
@@ -461,15 +775,13 @@ class VendingMachine:
                 def payment_callback(task):
                     try:
                         response = task.result()
-                        if response.get(
-                            "success", False
-                        ) and 'ActionCode="APPROVE"' in response.get(
-                            "raw_response", ""
-                        ):
+                        if response.success:
                             logger.info("✓ Payment approved")
 
                             # log the transaction
-                            Transaction.insert(
+                            self._paid_at = int(time.time())
+                            persistence.submit(
+                                Transaction.insert,
                                 {
                                     "selection": self.current_selection,
                                     "transaction_id": self._current_transaction_id,
@@ -480,11 +792,12 @@ class VendingMachine:
                                     "amount": amount,
                                     "date": datetime.now().strftime("%a %d %B %Y"),
                                     "time": datetime.now().strftime("%H:%M:%S"),
-                                }
+                                    "timestamp": self._paid_at,
+                                },
                             )
 
                             selection = self.current_selection
-                            selection_data = Prices.get(query.selection == selection)
+                            selection_data = Prices.get_selection(selection)
 
                             if selection_data and self.serial_connected:
                                 # Set state to dispensing
@@ -508,11 +821,25 @@ class VendingMachine:
                                 logger.error(
                                     f"✗ Error: Could not dispense - serial disconnected or selection not found"
                                 )
+                                # Charged without a dispense attempt, refund it
+                                self._reverse_payment(
+                                    self._current_transaction_id,
+                                    {
+                                        "selection": selection,
+                                        "product_name": self.current_selection_data.get(
+                                            "product_name", ""
+                                        ),
+                                        "amount": amount,
+                                        "original_timestamp": self._paid_at,
+                                    },
+                                    status="not_dispensed",
+                                )
                                 asyncio.create_task(self.cancel_selection())
 
                         else:
 
-                            Transaction.insert(
+                            persistence.submit(
+                                Transaction.insert,
                                 {
                                     "selection": self.current_selection,
                                     "transaction_id": self._current_transaction_id,
@@ -523,16 +850,33 @@ class VendingMachine:
                                     "amount": amount,
                                     "date": datetime.now().strftime("%a %d %B %Y"),
                                     "time": datetime.now().strftime("%H:%M:%S"),
-                                }
+                                    "timestamp": int(time.time()),
+                                },
                             )
                             error_msg = (
-                                self._extract_error_message(
-                                    response.get("raw_response", "")
-                                )
+                                self._extract_error_message(response)
                                 or "Transaction declined"
                             )
                             logger.error(f"✗ Payment failed: {error_msg}")
                             asyncio.create_task(self.cancel_selection())
+                    except ESocketTimeout as e:
+                        # The card may have been charged, never dispense or resend
+                        logger.error(f"✗ Payment timed out, reversing: {e}")
+                        self._reverse_payment(
+                            self._current_transaction_id,
+                            {
+                                "selection": self.current_selection,
+                                "product_name": self.current_selection_data.get(
+                                    "product_name", ""
+                                ),
+                                "amount": amount,
+                            },
+                            status="timeout",
+                        )
+                        asyncio.create_task(self.cancel_selection())
+                    except asyncio.CancelledError:
+                        # SELECT_CANCEL, _send_purchase reversed it if needed
+                        logger.info("Payment cancelled")
                     except Exception as e:
                         logger.error(f"✗ Payment error: {str(e)}")
                         asyncio.create_task(self.cancel_selection())
@@ -541,8 +885,14 @@ class VendingMachine:
                         self._current_transaction_task = None
 
                 self._current_transaction_task = asyncio.create_task(
-                    self.esocket_client.send_purchase_transaction(
-                        transaction_id=transaction_id, amount=amount
+                    self._send_purchase(
+                        transaction_id,
+                        amount,
+                        {
+                            "selection": selection,
+                            "product_name": selection_data.get("product_name", ""),
+                            "amount": amount,
+                        },
                     )
                 )
                 self._current_transaction_task.add_done_callback(payment_callback)
@@ -554,23 +904,16 @@ class VendingMachine:
             await self.cancel_selection()
         finally:
             if self.serial_connected:
-                await self._send_command(VMC_COMMANDS["ACK"]["code"])
+                await self._send_ack()
 
     @staticmethod
-    def _extract_error_message(raw_response):
-        """Extract error message from response"""
-        try:
-            if 'ErrorMessage="' in raw_response:
-                start = raw_response.index('ErrorMessage="') + 14
-                end = raw_response.index('"', start)
-                return raw_response[start:end]
-            elif 'ActionCode="' in raw_response:
-                start = raw_response.index('ActionCode="') + 12
-                end = raw_response.index('"', start)
-                return f"Transaction declined: {raw_response[start:end]}"
-        except Exception as e:
-            logger.error(f"Error extracting error: {str(e)}")
-        return None
+    def _extract_error_message(response):
+        """Extract error message from a parsed eSocket response"""
+        if response.error_message:
+            return response.error_message
+        if response.action_code:
+            return f"Transaction declined: {response.action_code}"
+        return response.error
 
     async def _handle_dispensing_status(self, payload):
         """Enhanced dispensing status handler with reversal support"""
@@ -591,7 +934,8 @@ class VendingMachine:
             logger.info(f"Product #{selection} dispensed successfully")
 
             # save the sales record
-            Sales.insert(
+            persistence.submit(
+                Sales.insert,
                 {
                     "selection": selection,
                     "transaction_id": self._current_transaction_id,
@@ -602,19 +946,17 @@ class VendingMachine:
                     "amount": self.amount,
                     "date": datetime.now().strftime("%a %d %B %Y"),
                     "time": datetime.now().strftime("%H:%M:%S"),
-                }
+                    "timestamp": int(time.time()),
+                },
             )
 
             current_inventory = self.current_selection_data.get("inventory", 0)
             new_inventory = max(0, current_inventory - 1)
 
             # Update individual selection
-            Prices.update(
-                {
-                    "inventory": new_inventory,
-                },
-                query.selection == selection,
-            )
+            Prices.update_selection(selection, {"inventory": new_inventory})
+            self._emit("dispense", selection=selection, status="success")
+            self._emit("inventory", selection=selection, inventory=new_inventory)
 
             # reset the machine state
             await self.reset_machine_state()
@@ -625,7 +967,8 @@ class VendingMachine:
                 f"Product #{selection} - Error: Product may be stuck (code: {status_code:02X})"
             )
 
-            Sales.insert(
+            persistence.submit(
+                Sales.insert,
                 {
                     "selection": selection,
                     "transaction_id": self._current_transaction_id,
@@ -636,10 +979,27 @@ class VendingMachine:
                     "amount": self.amount,
                     "date": datetime.now().strftime("%a %d %B %Y"),
                     "time": datetime.now().strftime("%H:%M:%S"),
-                }
+                    "timestamp": int(time.time()),
+                },
+            )
+            self._emit(
+                "dispense", selection=selection, status="error", code=status_code
             )
 
-
+            # The customer paid for nothing, refund in the background
+            if self._current_transaction_id:
+                self._reverse_payment(
+                    self._current_transaction_id,
+                    {
+                        "selection": selection,
+                        "product_name": self.current_selection_data.get(
+                            "product_name", ""
+                        ),
+                        "amount": self.amount,
+                        "sale_id": self.sale_id,
+                        "original_timestamp": self._paid_at,
+                    },
+                )
 
             await self.reset_machine_state()
 
@@ -686,7 +1046,7 @@ class VendingMachine:
 
         # Send a final ACK to ensure the machine is in a good state
         if self.serial_connected:
-            await self._send_command(VMC_COMMANDS["ACK"]["code"])
+            await self._send_ack()
 
         return True
 
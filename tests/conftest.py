@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# db.core opens its databases in the working directory on import, keep them
+# out of the checkout
+os.chdir(tempfile.mkdtemp(prefix="vending-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.persistence import PersistenceWorker
+
+
+@pytest.fixture
+def persistence():
+    worker = PersistenceWorker()
+    yield worker
+    worker.stop(timeout=5)
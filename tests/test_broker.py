@@ -0,0 +1,284 @@
+import asyncio
+import json
+
+import paho.mqtt.client as mqtt
+import pytest
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+import services.broker as broker_module
+from db.journal import JournalTable
+from db.prices import PriceTable
+
+
+class PublishInfo:
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+
+class FakeClient:
+    """Stands in for the paho client, keeps what was published"""
+
+    def __init__(self, *args, **kwargs):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, json.loads(payload)))
+        return PublishInfo()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+@pytest.fixture
+def make_broker(tmp_path, persistence, monkeypatch):
+    """Build a connected broker on fresh tables, call it on the running loop"""
+    for name in ("Sales", "Transaction", "Outbox"):
+        table = JournalTable(str(tmp_path / f"{name.lower()}.jsonl"))
+        monkeypatch.setattr(broker_module, name, table)
+    monkeypatch.setattr(broker_module, "persistence", persistence)
+    monkeypatch.setattr(broker_module.mqtt, "Client", FakeClient)
+
+    def make(vending_machine=None):
+        broker = broker_module.MQTTBroker(vending_machine)
+        broker.connected = True
+        return broker
+
+    return make
+
+
+def published(broker, suffix):
+    topic = f"vmc/{broker.machine_id}/{suffix}"
+    return [payload for name, payload in broker.client.published if name == topic]
+
+
+def test_get_sales_chunks_and_continues_from_cursor(make_broker):
+    async def run():
+        broker = make_broker()
+        broker.PAGE_SIZE = 10
+        for i in range(25):
+            broker_module.Sales.insert({"i": i})
+
+        await broker._handle_get_sales({"limit": 15, "request_id": "a"})
+        first = published(broker, "sales_update_status")
+        await broker._handle_get_sales({"cursor": first[-1]["next_cursor"]})
+        return broker, first, published(broker, "sales_update_status")[2:]
+
+    broker, first, rest = asyncio.run(run())
+
+    assert [len(chunk["sales"]) for chunk in first] == [10, 5]
+    assert [chunk["chunk"] for chunk in first] == [0, 1]
+    assert [chunk["last"] for chunk in first] == [False, True]
+    assert first[0]["next_cursor"] == 10
+    assert first[1]["next_cursor"] == 15
+    assert all(chunk["request_id"] == "a" for chunk in first)
+
+    assert [record["id"] for chunk in rest for record in chunk["sales"]] == list(
+        range(16, 26)
+    )
+    assert rest[-1]["last"] and rest[-1]["next_cursor"] is None
+
+
+def test_get_transactions_filters_by_status(make_broker):
+    async def run():
+        broker = make_broker()
+        for status in ("approved", "declined", "approved", "reversed"):
+            broker_module.Transaction.insert({"status": status})
+        await broker._handle_get_transactions({"status": ["approved", "reversed"]})
+        return published(broker, "transactions_update_status")
+
+    (response,) = asyncio.run(run())
+    assert [record["id"] for record in response["transactions"]] == [1, 3, 4]
+    assert response["last"] and response["next_cursor"] is None
+
+
+def test_get_sales_rejects_invalid_limit(make_broker):
+    async def run():
+        broker = make_broker()
+        await broker._handle_get_sales({"limit": -1, "request_id": 7})
+        return published(broker, "sales_update_status")
+
+    (response,) = asyncio.run(run())
+    assert response == {
+        "success": False,
+        "error": "limit must be positive",
+        "request_id": 7,
+    }
+
+
+def test_new_records_are_pushed_with_their_sequence(make_broker):
+    async def run():
+        broker = make_broker()
+        broker_module.Sales.insert({"i": 0})
+        broker_module.Sales.insert({"i": 1})
+        # Listener hands the push to the loop
+        await asyncio.sleep(0)
+        return published(broker, "sales_sync")
+
+    pushed = asyncio.run(run())
+    assert [message["records"] for message in pushed] == [
+        [{"seq": 1, "i": 0}],
+        [{"seq": 2, "i": 1}],
+    ]
+    assert [message["last_seq"] for message in pushed] == [1, 2]
+
+
+def test_sync_pushes_after_cursor_and_ack_archives(make_broker, persistence):
+    async def run():
+        broker = make_broker()
+        broker.PAGE_SIZE = 2
+        broker.connected = False  # no live pushes while filling the tables
+        for i in range(5):
+            broker_module.Sales.insert({"i": i})
+        broker_module.Transaction.insert({"status": "approved"})
+        await asyncio.sleep(0)
+        broker.connected = True
+
+        await broker._handle_sync({"sales": 2})
+        synced = list(broker.client.published)
+        broker.client.published.clear()
+
+        await broker._handle_sync_ack({"sales": 4, "transactions": "x"})
+        await asyncio.to_thread(persistence.stop, 5)
+        await broker._handle_sync({})
+        return synced, list(broker.client.published)
+
+    synced, resynced = asyncio.run(run())
+    sales = [message for topic, message in synced if topic.endswith("sales_sync")]
+    assert [[r["seq"] for r in message["records"]] for message in sales] == [
+        [3, 4],
+        [5],
+    ]
+    # Streams left out of the request start from the oldest record
+    transactions = [m for t, m in synced if t.endswith("transactions_sync")]
+    assert [message["last_seq"] for message in transactions] == [1]
+
+    # Acknowledged sales are archived, the invalid transactions ack is ignored
+    assert [(topic.rsplit("/", 1)[-1], m["last_seq"]) for topic, m in resynced] == [
+        ("sales_sync", 5),
+        ("transactions_sync", 1),
+    ]
+    assert len(broker_module.Sales) == 1
+
+
+def test_writes_to_a_selection_keep_arrival_order(make_broker):
+    async def run():
+        broker = make_broker()
+        finished = []
+
+        async def handler(payload):
+            await asyncio.sleep(payload["delay"])
+            finished.append(payload["name"])
+
+        for suffix in ("set_price", "set_inventory", "batch", "ping"):
+            broker._topic_handlers[f"vmc/{broker.machine_id}/{suffix}"] = handler
+
+        def message(suffix, **payload):
+            topic = f"vmc/{broker.machine_id}/{suffix}"
+            return broker._handle_message({"topic": topic, "payload": payload})
+
+        await asyncio.gather(
+            message("set_price", name="slow", selection=5, delay=0.05),
+            message("set_inventory", name="same", selection=5, delay=0),
+            message("set_price", name="other", selection=6, delay=0.01),
+            message("set_price", name="tray", tray=0, delay=0),
+            message(
+                "batch",
+                name="batch",
+                operations=[{"selection": 6}, {"selection": 42}],
+                delay=0,
+            ),
+            message("ping", name="ping", delay=0),
+        )
+        return broker, finished
+
+    broker, finished = asyncio.run(run())
+    # Tray 0 covers selections 1-10, so it waits for both 5 and 6
+    assert finished.index("slow") < finished.index("same")
+    assert finished.index("same") < finished.index("tray")
+    assert finished.index("other") < finished.index("batch")
+    assert finished.index("other") < finished.index("slow")
+    assert finished[0] == "ping"
+    assert broker._key_tails == {}
+    assert broker._in_flight == 0
+
+
+class FakeVendingMachine:
+    def __init__(self, refused=()):
+        self.commands = []
+        self.refused = refused
+
+    def add_listener(self, callback):
+        pass
+
+    async def queue_command(self, command, data):
+        self.commands.append((command, data))
+        return command not in self.refused
+
+
+def test_batch_reports_every_operation(make_broker, persistence, monkeypatch):
+    prices = PriceTable(TinyDB(storage=MemoryStorage).table("prices"), persistence)
+    prices.apply(upserts={12: {"price": 100}})
+    monkeypatch.setattr(broker_module, "Prices", prices)
+    machine = FakeVendingMachine(refused=("SET_CAPACITY",))
+
+    async def run():
+        broker = make_broker(machine)
+        await broker._handle_batch(
+            {
+                "request_id": "b1",
+                "operations": [
+                    {"type": "price", "selection": 5, "price": 250},
+                    {"type": "colour", "selection": 5},
+                    {"type": "inventory", "tray": 1, "inventory": 3},
+                    {"type": "capacity", "selection": 12, "capacity": 8},
+                    {"type": "price", "selection": 101, "price": 1},
+                ],
+            }
+        )
+        return published(broker, "batch_status")
+
+    (response,) = asyncio.run(run())
+    assert response["request_id"] == "b1"
+    assert (response["success"], response["applied"], response["failed"]) == (
+        False,
+        2,
+        3,
+    )
+    assert [(r["index"], r["success"]) for r in response["results"]] == [
+        (0, True),
+        (1, False),
+        (2, True),
+        (3, False),
+        (4, False),
+    ]
+    assert response["results"][2]["special_selection"] == 1001
+    assert "type must be one of" in response["results"][1]["error"]
+
+    # Valid operations reach the VMC in order and the database in one write
+    assert machine.commands == [
+        ("SET_PRICE", bytes([0, 5, 0, 0, 0, 250])),
+        ("SET_INVENTORY", bytes([3, 233, 3])),
+        ("SET_CAPACITY", bytes([0, 12, 8])),
+    ]
+    assert prices.get_selection(5)["price"] == 250
+    assert prices.get_selection(15)["inventory"] == 3
+    # Tray 1 covers selection 12 as well
+    assert prices.get_selection(12) == {
+        "selection": 12,
+        "price": 100,
+        "inventory": 3,
+        "capacity": 8,
+    }
+
+
+def test_batch_without_operations_fails(make_broker):
+    async def run():
+        broker = make_broker(FakeVendingMachine())
+        await broker._handle_batch({"operations": []})
+        return published(broker, "batch_status")
+
+    (response,) = asyncio.run(run())
+    assert response == {
+        "success": False,
+        "error": "operations must be a non-empty list",
+    }
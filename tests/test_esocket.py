@@ -0,0 +1,120 @@
+import xml.etree.ElementTree as ET
+
+from services.esocket import (
+    ESP_NAMESPACE,
+    PURCHASE_TEMPLATE,
+    MessageTemplate,
+    init_template,
+    parse_response,
+)
+
+
+def split(frame):
+    """Length header and body of a rendered message"""
+    if frame[:2] == b"\xff\xff":
+        return int.from_bytes(frame[2:6], "big"), frame[6:]
+    return frame[0] * 256 + frame[1], frame[2:]
+
+
+def envelope(body):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Esp:Interface Version="1.0" xmlns:Esp="{ESP_NAMESPACE}">{body}'
+        "</Esp:Interface>"
+    )
+
+
+def test_render_matches_elementtree():
+    frame = PURCHASE_TEMPLATE.render(
+        TerminalId="TERM0001",
+        TransactionId="123456",
+        TransactionAmount=250,
+        CurrencyCode="840",
+    )
+    length, body = split(frame)
+    assert length == len(body)
+
+    ET.register_namespace("Esp", ESP_NAMESPACE)
+    root = ET.Element("Esp:Interface", {"Version": "1.0", "xmlns:Esp": ESP_NAMESPACE})
+    ET.SubElement(
+        root,
+        "Esp:Transaction",
+        {
+            "TerminalId": "TERM0001",
+            "TransactionId": "123456",
+            "Type": "PURCHASE",
+            "TransactionAmount": "250",
+            "CurrencyCode": "840",
+        },
+    )
+    expected = ET.tostring(root, encoding="UTF-8", xml_declaration=True)
+    assert body.decode() == expected.decode().replace("'", '"')
+
+
+def test_render_escapes_and_omits_none():
+    template = MessageTemplate("Esp:Test", [("A", None), ("B", None), ("C", "x&y")])
+    _, body = split(template.render(A='"<&>"', B=None))
+    assert body.decode() == envelope(
+        '<Esp:Test A="&quot;&lt;&amp;&gt;&quot;" C="x&amp;y" />'
+    )
+    assert ET.fromstring(body).find(f"{{{ESP_NAMESPACE}}}Test").get("A") == '"<&>"'
+
+
+def test_long_message_uses_six_byte_header():
+    template = MessageTemplate("Esp:Test", [("Data", None)])
+    length, body = split(template.render(Data="x" * 70000))
+    assert length == len(body) > 65535
+
+
+def test_init_registers_only_given_callbacks():
+    _, body = split(init_template().render(TerminalId="T1"))
+    assert b'Type="EVENT" EventId="PROMPT_INSERT_CARD"' in body
+    assert b'Type="CALLBACK"' not in body
+
+    _, body = split(init_template(("AUTHORIZE",)).render(TerminalId="T1"))
+    assert body.count(b'Type="CALLBACK"') == 1
+    assert b'EventId="AUTHORIZE"' in body
+
+
+def test_parse_approved_transaction():
+    response = parse_response(
+        envelope(
+            '<Esp:Transaction ActionCode="APPROVE" ResponseCode="00" '
+            "TransactionId='123456' MessageReasonCode=\"9791\"/>"
+        )
+    )
+    assert response.success
+    assert response.element == "Transaction"
+    assert response.transaction_id == "123456"
+    assert response.response_code == "00"
+    assert response.message_reason_code == "9791"
+
+
+def test_parse_error_element_is_not_success():
+    response = parse_response(
+        envelope('<Esp:Error ActionCode="DECLINE" ResponseCode="30"></Esp:Error>')
+    )
+    assert response.element == "Error"
+    assert not response.success
+    assert response.response_code == "30"
+
+
+def test_parse_malformed_xml():
+    response = parse_response(envelope('<Esp:Transaction ActionCode="APPROVE"')[:-5])
+    assert response.error is not None
+    assert not response.success
+
+
+def test_parse_event_and_callback():
+    event = parse_response(
+        envelope('<Esp:Event TerminalId="T1" EventId="PROMPT_PIN" EventData="x"/>')
+    )
+    assert (event.element, event.event_id, event.event_data) == (
+        "Event",
+        "PROMPT_PIN",
+        "x",
+    )
+    callback = parse_response(
+        envelope('<Esp:Callback EventId="AUTHORIZE" EventData=""/>')
+    )
+    assert (callback.element, callback.event_data) == ("Callback", "")
@@ -0,0 +1,119 @@
+import json
+
+from db.journal import JournalTable
+
+
+def test_insert_get_update_remove(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    first = table.insert({"a": 1})
+    second = table.insert({"a": 2})
+    assert (first, second) == (1, 2)
+
+    assert table.update({"b": True}, doc_ids=[first]) == [first]
+    assert table.get(doc_id=first) == {"a": 1, "b": True}
+    assert table.remove(doc_ids=[second]) == [second]
+    assert table.get(doc_id=second) is None
+    assert len(table) == 1
+
+
+def test_reload_keeps_latest_versions_and_ids(tmp_path):
+    path = str(tmp_path / "t.jsonl")
+    table = JournalTable(path)
+    for i in range(3):
+        table.insert({"i": i})
+    table.update({"i": 10}, doc_ids=[1])
+    table.remove(doc_ids=[3])
+    table.close()
+
+    table = JournalTable(path)
+    assert [(doc.doc_id, doc["i"]) for doc in table.all()] == [(1, 10), (2, 1)]
+    # A removed id is never handed out again
+    assert table.insert({"i": 4}) == 4
+
+
+def test_page_skips_removed_and_stays_ordered(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    for i in range(10):
+        table.insert({"i": i})
+    table.remove(doc_ids=[3, 4, 5])
+    table.update({"i": 0}, doc_ids=[2])
+
+    assert [doc.doc_id for doc in table.page(after=0, limit=3)] == [1, 2, 6]
+    assert [doc.doc_id for doc in table.page(after=2, limit=3)] == [6, 7, 8]
+    assert [doc.doc_id for doc in table.page(after=4, limit=100)] == [6, 7, 8, 9, 10]
+    assert table.page(after=10) == []
+    assert table.last_id() == 10
+    table.remove(doc_ids=[9, 10])
+    assert table.last_id() == 8
+
+
+def test_pages_cover_every_record_once(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    for i in range(250):
+        table.insert({"i": i})
+
+    seen, after = [], 0
+    while page := table.page(after=after, limit=100):
+        seen.extend(doc["i"] for doc in page)
+        after = page[-1].doc_id
+    assert seen == list(range(250))
+
+
+def test_archive_moves_records(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    for i in range(5):
+        table.insert({"i": i})
+
+    assert table.archive(3) == [1, 2, 3]
+    assert [doc.doc_id for doc in table.all()] == [4, 5]
+    with open(table.archive_path) as f:
+        archived = [json.loads(line) for line in f]
+    assert [entry["id"] for entry in archived] == [1, 2, 3]
+    assert table.archive(3) == []
+
+
+def test_torn_write_is_dropped(tmp_path):
+    path = str(tmp_path / "t.jsonl")
+    table = JournalTable(path)
+    table.insert({"i": 1})
+    table.close()
+    with open(path, "ab") as f:
+        f.write(b'{"id":2,"doc":{"i"')
+
+    table = JournalTable(path)
+    assert len(table) == 1
+    assert table.insert({"i": 2}) == 2
+    assert table.get(doc_id=2) == {"i": 2}
+
+
+def test_compaction_keeps_records_and_ids(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    for i in range(20):
+        table.insert({"i": i})
+    table.remove(doc_ids=range(1, 21))
+    table.insert({"i": 20})
+    table.compact()
+
+    assert [doc.doc_id for doc in table.all()] == [21]
+    assert table.insert({"i": 21}) == 22
+    assert [doc.doc_id for doc in table.page()] == [21, 22]
+
+
+def test_listeners_see_inserts(tmp_path):
+    table = JournalTable(str(tmp_path / "t.jsonl"))
+    seen = []
+    table.add_listener(lambda doc_id, doc: seen.append((doc_id, dict(doc))))
+    table.add_listener(lambda doc_id, doc: 1 / 0)  # errors are logged, not raised
+
+    table.insert({"i": 1})
+    table.update({"i": 2}, doc_ids=[1])
+    assert seen == [(1, {"i": 1})]
+
+
+def test_legacy_tinydb_file_is_imported(tmp_path):
+    legacy = tmp_path / "sales.json"
+    legacy.write_text(json.dumps({"sales": {"2": {"i": 2}, "1": {"i": 1}}}))
+    table = JournalTable(
+        str(tmp_path / "sales.jsonl"), legacy_path=str(legacy), legacy_table="sales"
+    )
+    assert [(doc.doc_id, doc["i"]) for doc in table.all()] == [(1, 1), (2, 2)]
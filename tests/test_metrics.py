@@ -0,0 +1,37 @@
+from utils.metrics import LatencyHistogram
+
+
+def test_percentiles_within_bucket_error():
+    histogram = LatencyHistogram()
+    for value in range(1, 100_001):
+        histogram.record(value)
+
+    for percentile in (50, 90, 99, 99.9):
+        exact = 100_000 * percentile / 100
+        assert abs(histogram.percentile(percentile) - exact) <= exact * 0.03
+    assert histogram.percentile(100) == histogram.max == 100_000
+    assert histogram.min == 1
+    assert histogram.mean() == 50_000.5
+
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for value in (0, 1, 7, 31):
+        histogram.record(value)
+    assert [histogram.percentile(p) for p in (25, 50, 75, 100)] == [0, 1, 7, 31]
+
+
+def test_percentile_never_exceeds_max():
+    histogram = LatencyHistogram()
+    histogram.record(1_000_001)
+    assert histogram.percentile(50) == 1_000_001
+
+
+def test_reset():
+    histogram = LatencyHistogram()
+    histogram.record(500)
+    histogram.reset()
+    assert histogram.count == 0
+    assert histogram.percentile(99) == 0
+    assert histogram.mean() == 0
+    assert histogram.min is None
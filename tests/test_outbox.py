@@ -0,0 +1,79 @@
+import asyncio
+
+from db.journal import JournalTable
+from services.outbox import MessageOutbox
+
+
+def drain(outbox, publish, attempts=100):
+    """
+    Drain like the broker does, retrying while appends are still in flight
+    or publish refused a message. Returns True once the outbox is empty.
+    """
+
+    async def run():
+        for _ in range(attempts):
+            if await outbox.drain(publish):
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+    return asyncio.run(run())
+
+
+def test_drain_publishes_in_order(tmp_path, persistence):
+    outbox = MessageOutbox(JournalTable(str(tmp_path / "o.jsonl")), persistence)
+    for i in range(250):
+        outbox.put("t", str(i), qos=1)
+    assert outbox.pending
+
+    sent = []
+    assert drain(outbox, lambda *m: sent.append(m) or True)
+    assert sent == [("t", str(i), 1, False) for i in range(250)]
+    assert not outbox.pending
+
+
+def test_drain_resumes_after_failed_publish(tmp_path, persistence):
+    outbox = MessageOutbox(JournalTable(str(tmp_path / "o.jsonl")), persistence)
+    for i in range(5):
+        outbox.put("t", str(i))
+
+    sent = []
+
+    def flaky(topic, payload, qos, retain):
+        if payload == "2" and "2" not in failed:
+            failed.append(payload)
+            return False
+        sent.append(payload)
+        return True
+
+    failed = []
+    assert drain(outbox, flaky)
+    assert failed == ["2"]
+    assert sent == ["0", "1", "2", "3", "4"]
+
+
+def test_full_outbox_drops_oldest(tmp_path, persistence):
+    outbox = MessageOutbox(JournalTable(str(tmp_path / "o.jsonl")), persistence)
+    outbox.MAX_MESSAGES = 3
+    for i in range(5):
+        outbox.put("t", str(i))
+
+    sent = []
+    assert drain(outbox, lambda t, p, q, r: sent.append(p) or True)
+    assert sent == ["2", "3", "4"]
+    assert not outbox.pending
+
+
+def test_buffered_messages_survive_restart(tmp_path, persistence):
+    path = str(tmp_path / "o.jsonl")
+    table = JournalTable(path)
+    outbox = MessageOutbox(table, persistence)
+    outbox.put("t", "kept")
+    persistence.stop(timeout=5)
+    table.close()
+
+    outbox = MessageOutbox(JournalTable(path), persistence)
+    assert outbox.pending
+    sent = []
+    assert drain(outbox, lambda t, p, q, r: sent.append(p) or True)
+    assert sent == ["kept"]
@@ -0,0 +1,62 @@
+from utils.packet import FrameParser, calculate_xor, encode_packet
+
+POLL = 0x41
+
+
+def test_encoded_packet_has_valid_checksum():
+    packet = encode_packet(0x03, 7, b"\x01\x02")
+    assert packet[:2] == b"\xfa\xfb"
+    assert packet[3] == 3  # packet number + data
+    assert calculate_xor(packet[:-1]) == packet[-1]
+
+
+def test_burst_is_split_into_packets():
+    parser = FrameParser()
+    first, second = encode_packet(POLL, 1), encode_packet(0x03, 2, b"\x09")
+    parser.feed(first + second)
+    assert [bytes(p) for p in parser.packets()] == [first, second]
+    assert len(parser) == 0
+
+
+def test_packet_split_across_reads():
+    parser = FrameParser()
+    packet = encode_packet(0x03, 2, b"\x01\x02\x03")
+    parser.feed(packet[:4])
+    assert list(parser.packets()) == []
+    parser.feed(packet[4:])
+    assert [bytes(p) for p in parser.packets()] == [packet]
+
+
+def test_noise_before_stx_is_skipped():
+    parser = FrameParser()
+    packet = encode_packet(POLL, 1)
+    parser.feed(b"\x00\x13\x37" + packet)
+    assert [bytes(p) for p in parser.packets()] == [packet]
+
+
+def test_stx_split_between_reads():
+    parser = FrameParser()
+    packet = encode_packet(POLL, 1)
+    parser.feed(b"\x00\x00\x00\x00\x00\xfa")
+    assert list(parser.packets()) == []
+    parser.feed(packet[1:])
+    assert [bytes(p) for p in parser.packets()] == [packet]
+
+
+def test_bad_checksum_resyncs_on_next_packet():
+    parser = FrameParser()
+    bad = bytearray(encode_packet(0x03, 1, b"\x05"))
+    bad[-1] ^= 0xFF
+    good = encode_packet(POLL, 2)
+    parser.feed(bytes(bad) + good)
+    assert [bytes(p) for p in parser.packets()] == [good]
+
+
+def test_feed_while_packet_is_referenced():
+    parser = FrameParser()
+    first, second = encode_packet(POLL, 1), encode_packet(POLL, 2)
+    parser.feed(first)
+    held = next(parser.packets())
+    parser.feed(second)
+    assert bytes(held) == first
+    assert [bytes(p) for p in parser.packets()] == [second]
@@ -0,0 +1,76 @@
+import threading
+
+from db.persistence import PersistenceWorker
+
+
+class FakeStorage:
+    def __init__(self):
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+def test_writes_applied_in_submission_order():
+    worker = PersistenceWorker()
+    applied = []
+    for i in range(500):
+        worker.submit(applied.append, i)
+    worker.stop(timeout=5)
+    assert applied == list(range(500))
+
+
+def test_failed_write_does_not_stop_the_batch():
+    worker = PersistenceWorker()
+    applied = []
+
+    def fail():
+        raise RuntimeError("disk full")
+
+    worker.submit(applied.append, 1)
+    worker.submit(fail)
+    worker.submit(applied.append, 2)
+    worker.stop(timeout=5)
+    assert applied == [1, 2]
+
+
+def test_writes_hold_the_lock():
+    worker = PersistenceWorker()
+    held = []
+
+    def write():
+        # The lock is reentrant, so only the owner can acquire it while held
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(worker.lock.acquire(blocking=False))
+        )
+        thread.start()
+        thread.join()
+        held.append(not acquired[0])
+
+    worker.submit(write)
+    worker.stop(timeout=5)
+    assert held == [True]
+
+
+def test_stop_flushes_storages():
+    storage = FakeStorage()
+    worker = PersistenceWorker(storage)
+    worker.FLUSH_INTERVAL = 60
+    worker.submit(lambda: None)
+    worker.stop(timeout=5)
+    assert storage.flushes == 1
+
+    # Nothing running, stop still writes the caches out
+    worker.stop(timeout=5)
+    assert storage.flushes == 2
+
+
+def test_submit_after_stop_restarts_the_worker():
+    worker = PersistenceWorker()
+    applied = []
+    worker.submit(applied.append, 1)
+    worker.stop(timeout=5)
+    worker.submit(applied.append, 2)
+    worker.stop(timeout=5)
+    assert applied == [1, 2]
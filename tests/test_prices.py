@@ -0,0 +1,47 @@
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from db.prices import PriceTable
+
+
+def make_table(persistence, documents=()):
+    table = TinyDB(storage=MemoryStorage).table("prices")
+    for document in documents:
+        table.insert(document)
+    return table, PriceTable(table, persistence)
+
+
+def test_lookup_and_writes_reach_tinydb(persistence):
+    table, prices = make_table(persistence, [{"selection": 1, "price": 100}])
+    assert prices.get_selection(1) == {"selection": 1, "price": 100}
+    assert prices.get_selection(2) is None
+
+    assert prices.bulk_upsert({2: {"price": 200}}) == [2]
+    assert prices.bulk_update({1: {"price": 150}, 3: {"price": 1}}) == [1]
+    persistence.stop(timeout=5)
+
+    stored = {doc["selection"]: doc["price"] for doc in table.all()}
+    assert stored == {1: 150, 2: 200}
+
+
+def test_changes_since_version(persistence):
+    _, prices = make_table(persistence, [{"selection": 1, "price": 100}])
+    start = prices.version
+    assert prices.changes_since(start) == []
+
+    prices.upsert_selection(2, {"price": 200})
+    middle = prices.version
+    prices.update_selection(1, {"price": 110})
+
+    assert sorted(doc["selection"] for doc in prices.changes_since(start)) == [1, 2]
+    assert prices.changes_since(middle) == [{"selection": 1, "price": 110}]
+    assert prices.changes_since(prices.version) == []
+
+
+def test_unknown_version_needs_full_read(persistence):
+    _, prices = make_table(persistence)
+    assert prices.changes_since("other-1") is None
+    # A counter ahead of the table comes from before a restart
+    epoch = prices.version.partition("-")[0]
+    assert prices.changes_since(f"{epoch}-5") is None
+    assert prices.changes_since("garbage") is None
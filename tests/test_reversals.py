@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+import services.reversals as reversals_module
+from db.journal import JournalTable
+from services.esocket import ESocketResponse
+from services.reversals import ReversalQueue
+
+
+class FakeClient:
+    """Answers reversals with the queued responses, None means not sent"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.is_connected = True
+
+    async def send_reversal_transaction(self, **fields):
+        self.sent.append(fields)
+        response = self.responses.pop(0)
+        if response is None:
+            raise ConnectionError("connection lost")
+        return response
+
+
+def approved():
+    return ESocketResponse("", element="Transaction", action_code="APPROVE")
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Record the retry delays without waiting for them"""
+    recorded = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        recorded.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(reversals_module.asyncio, "sleep", fake_sleep)
+    return recorded
+
+
+def run_until_answered(queue, count=1, put=()):
+    """Run the queue until count reversals were answered"""
+
+    async def run():
+        answered = []
+        done = asyncio.Event()
+
+        def listener(entry, response):
+            answered.append((entry, response))
+            if len(answered) == count:
+                done.set()
+
+        queue.add_listener(listener)
+        for transaction_id, details in put:
+            queue.put(transaction_id, details=details)
+        task = asyncio.create_task(queue.run())
+        await asyncio.wait_for(done.wait(), 5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return answered
+
+    return asyncio.run(run())
+
+
+def test_reversal_reuses_the_purchase_transaction_id(tmp_path, persistence):
+    table = JournalTable(str(tmp_path / "r.jsonl"))
+    client = FakeClient(approved())
+    queue = ReversalQueue(table, persistence, client)
+
+    ((entry, response),) = run_until_answered(queue, put=[("000123", {"selection": 5})])
+    assert client.sent == [
+        {
+            "transaction_id": "000123",
+            "original_transaction_id": "000123",
+            "reason_code": None,
+        }
+    ]
+    assert entry["details"] == {"selection": 5}
+    assert response.success
+
+    persistence.stop(timeout=5)
+    assert len(queue) == 0
+
+
+def test_retries_with_backoff_until_answered(tmp_path, persistence, delays):
+    table = JournalTable(str(tmp_path / "r.jsonl"))
+    error = ESocketResponse("", element="Error", response_code="05")
+    declined = ESocketResponse("", element="Transaction", action_code="DECLINE")
+    client = FakeClient(None, error, None, None, None, None, None, declined)
+    queue = ReversalQueue(table, persistence, client)
+    queue.MAX_RETRY_DELAY = 40
+
+    ((entry, response),) = run_until_answered(queue, put=[("000124", None)])
+    # An Esp:Error is not an answer, a decline is
+    assert len(client.sent) == 8
+    assert {fields["transaction_id"] for fields in client.sent} == {"000124"}
+    assert delays == [5, 10, 20, 40, 40, 40, 40]
+    assert not response.success
+
+    persistence.stop(timeout=5)
+    assert len(queue) == 0
+
+
+def test_waits_while_the_client_is_disconnected(tmp_path, persistence, monkeypatch):
+    table = JournalTable(str(tmp_path / "r.jsonl"))
+    client = FakeClient(approved())
+    client.is_connected = False
+    queue = ReversalQueue(table, persistence, client)
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        client.is_connected = len(delays) == 3
+        await sleep(0)
+
+    monkeypatch.setattr(reversals_module.asyncio, "sleep", fake_sleep)
+
+    run_until_answered(queue, put=[("000125", None)])
+    assert delays == [5, 10, 20]
+    assert len(client.sent) == 1
+
+
+def test_queued_reversals_survive_a_restart(tmp_path, persistence):
+    path = str(tmp_path / "r.jsonl")
+    table = JournalTable(path)
+    queue = ReversalQueue(table, persistence, FakeClient())
+
+    async def put():
+        queue.put("000126")
+        queue.put("000127")
+
+    asyncio.run(put())
+    persistence.stop(timeout=5)
+    table.close()
+
+    table = JournalTable(path)
+    client = FakeClient(approved(), approved())
+    queue = ReversalQueue(table, persistence, client)
+    assert len(queue) == 2
+
+    answered = run_until_answered(queue, count=2)
+    assert [entry["transaction_id"] for entry, _ in answered] == ["000126", "000127"]
+    persistence.stop(timeout=5)
+    assert len(queue) == 0
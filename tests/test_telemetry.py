@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from services.telemetry import TelemetryPublisher
+
+
+def make_publisher(interval=1.0):
+    sent = []
+    publisher = TelemetryPublisher(
+        lambda topic, payload: sent.append((topic, json.loads(payload)["events"])),
+        "vmc/m/telemetry",
+        interval,
+    )
+    return publisher, sent
+
+
+def test_latest_only_events_are_coalesced_in_place():
+    publisher, sent = make_publisher()
+    publisher.record({"event": "inventory", "selection": 1, "inventory": 5})
+    publisher.record({"event": "dispense", "selection": 1})
+    publisher.record({"event": "inventory", "selection": 2, "inventory": 9})
+    publisher.record({"event": "inventory", "selection": 1, "inventory": 4})
+    publisher.record({"event": "connection", "link": "mqtt", "up": False})
+    publisher.record({"event": "connection", "link": "mqtt", "up": True})
+    publisher.record({"event": "dispense", "selection": 1})
+    publisher.flush()
+
+    assert sent == [
+        (
+            "vmc/m/telemetry",
+            [
+                {"event": "inventory", "selection": 1, "inventory": 4},
+                {"event": "dispense", "selection": 1},
+                {"event": "inventory", "selection": 2, "inventory": 9},
+                {"event": "connection", "link": "mqtt", "up": True},
+                {"event": "dispense", "selection": 1},
+            ],
+        )
+    ]
+
+
+def test_flush_starts_a_new_batch():
+    publisher, sent = make_publisher()
+    publisher.flush()
+    assert sent == []
+
+    publisher.record({"event": "inventory", "selection": 1, "inventory": 5})
+    publisher.flush()
+    publisher.record({"event": "inventory", "selection": 1, "inventory": 4})
+    publisher.flush()
+    assert [events[0]["inventory"] for _, events in sent] == [5, 4]
+
+
+def test_run_publishes_once_per_interval_and_on_cancel():
+    async def run():
+        publisher, sent = make_publisher(interval=0.02)
+        task = asyncio.create_task(publisher.run())
+        for i in range(3):
+            publisher.record({"event": "dispense", "selection": i})
+        await asyncio.sleep(0.05)
+        publisher.record({"event": "dispense", "selection": 9})
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return sent
+
+    sent = asyncio.run(run())
+    assert [[e["selection"] for e in events] for _, events in sent] == [[0, 1, 2], [9]]
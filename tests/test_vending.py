@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+import services.vending as vending_module
+from db.journal import JournalTable
+from db.prices import PriceTable
+from services.esocket import ESocketResponse, ESocketTimeout
+
+
+class FakeESocketClient:
+    """Purchases wait for the test to answer them"""
+
+    def __init__(self):
+        self.is_connected = True
+        self.purchases = []
+        self.response = None
+
+    async def send_purchase_transaction(self, transaction_id, amount, on_sent=None):
+        self.purchases.append(transaction_id)
+        if on_sent is not None:
+            on_sent()
+        self.response = asyncio.get_running_loop().create_future()
+        return await self.response
+
+
+@pytest.fixture
+def tables(tmp_path, persistence, monkeypatch):
+    tables = {
+        name: JournalTable(str(tmp_path / f"{name.lower()}.jsonl"))
+        for name in ("Transaction", "Sales", "Reversals")
+    }
+    tables["Prices"] = PriceTable(
+        TinyDB(storage=MemoryStorage).table("prices"), persistence
+    )
+    tables["Prices"].apply(upserts={5: {"price": 150, "product_name": "Cola"}})
+    for name, table in tables.items():
+        monkeypatch.setattr(vending_module, name, table)
+    monkeypatch.setattr(vending_module, "persistence", persistence)
+    return tables
+
+
+@pytest.fixture
+def machine(tables):
+    machine = vending_module.VendingMachine()
+    machine.esocket_client = FakeESocketClient()
+    machine.esocket_connected = True
+    return machine
+
+
+def pay(machine, answer):
+    """Select 5 and settle the purchase with answer(future) once it is sent"""
+
+    async def run():
+        machine.current_selection = 5
+        await machine._process_payment(5)
+        task = machine._current_transaction_task
+        await asyncio.sleep(0)
+        answer(machine.esocket_client.response)
+        await asyncio.gather(task, return_exceptions=True)
+        # Let the done callback and the tasks it starts finish
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+
+
+def test_purchase_cancelled_after_sending_is_reversed(machine, tables, persistence):
+    events = []
+    machine.add_listener(events.append)
+    details = {"selection": 5, "product_name": "Cola", "amount": 150}
+
+    async def run():
+        task = asyncio.create_task(machine._send_purchase("123456", 150, details))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+    asyncio.run(run())
+    persistence.stop(timeout=5)
+
+    (record,) = tables["Transaction"].all()
+    assert record["status"] == "cancelled"
+    assert record["transaction_id"] == "123456"
+    (entry,) = tables["Reversals"].all()
+    assert entry["transaction_id"] == "123456"
+    assert entry["details"] == {**details, "original_timestamp": record["timestamp"]}
+    assert [e["status"] for e in events if e["event"] == "reversal"] == ["pending"]
+
+
+def test_purchase_cancelled_before_sending_is_not_reversed(
+    machine, tables, persistence
+):
+    async def run():
+        task = asyncio.create_task(machine._send_purchase("123456", 150, {}))
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    persistence.stop(timeout=5)
+    assert machine.esocket_client.purchases == []
+    assert len(tables["Reversals"]) == 0
+    assert len(tables["Transaction"]) == 0
+
+
+def test_timed_out_purchase_is_reversed(machine, tables, persistence):
+    events = []
+    machine.add_listener(events.append)
+    pay(machine, lambda response: response.set_exception(ESocketTimeout("lost")))
+    persistence.stop(timeout=5)
+
+    (record,) = tables["Transaction"].all()
+    assert record["status"] == "timeout"
+    (entry,) = tables["Reversals"].all()
+    assert entry["transaction_id"] == machine.esocket_client.purchases[0]
+    assert entry["details"]["original_timestamp"] == record["timestamp"]
+    assert [e["status"] for e in events if e["event"] == "reversal"] == ["pending"]
+    assert machine.state == "idle"
+
+
+def approve(response):
+    response.set_result(
+        ESocketResponse("", element="Transaction", action_code="APPROVE")
+    )
+
+
+def test_approved_payment_that_cannot_dispense_is_reversed(
+    machine, tables, persistence
+):
+    # Serial link down, the product is never dispensed
+    pay(machine, approve)
+    persistence.stop(timeout=5)
+
+    approved, not_dispensed = tables["Transaction"].all()
+    assert approved["status"] == "approved"
+    assert not_dispensed["status"] == "not_dispensed"
+    (entry,) = tables["Reversals"].all()
+    assert entry["transaction_id"] == approved["transaction_id"]
+    assert entry["details"]["original_timestamp"] == approved["timestamp"]
+    assert entry["details"]["selection"] == 5
+    assert machine.state == "idle"
+
+
+def test_jammed_product_is_reversed(machine, tables, persistence):
+    machine._current_transaction_id = "123456"
+    machine.current_selection = 5
+    machine.current_selection_data = tables["Prices"].get_selection(5)
+    machine.amount = 150
+    machine.sale_id = "sale-1"
+    machine._paid_at = 1700000000
+
+    asyncio.run(machine._handle_dispensing_status(bytes([1, 0x03, 0, 5])))
+    persistence.stop(timeout=5)
+
+    (sale,) = tables["Sales"].all()
+    assert (sale["status"], sale["reason"]) == ("error", "jammed")
+    (record,) = tables["Transaction"].all()
+    assert record["status"] == "reversal_pending"
+    (entry,) = tables["Reversals"].all()
+    assert entry["transaction_id"] == "123456"
+    assert entry["details"] == {
+        "selection": 5,
+        "product_name": "Cola",
+        "amount": 150,
+        "sale_id": "sale-1",
+        "original_timestamp": 1700000000,
+    }
+    assert machine.state == "idle"
+
+
+def test_reversal_outcome_is_appended(machine, tables, persistence):
+    entry = {"transaction_id": "123456", "details": {"original_timestamp": 1}}
+    declined = ESocketResponse(
+        "", element="Transaction", action_code="DECLINE", response_code="12"
+    )
+    machine._on_reversal_done(entry, declined)
+    persistence.stop(timeout=5)
+
+    (record,) = tables["Transaction"].all()
+    assert record["status"] == "reversal_declined"
+    assert record["response_code"] == "12"
+    assert record["original_timestamp"] == 1
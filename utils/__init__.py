@@ -1,3 +1,9 @@
 from .commands import *
 
 from .logger import *
+
+from .packet import *
+
+from .metrics import *
+
+from .encoding import *
@@ -0,0 +1,44 @@
+import base64
+import json
+import zlib
+
+# Record encodings a request can ask for
+ENCODINGS = ("json", "columnar", "zlib", "columnar+zlib")
+
+
+def to_columns(records):
+    """Turn a list of dicts into one key list and a row of values per record"""
+    columns = []
+    seen = set()
+    for record in records:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+    return {
+        "columns": columns,
+        "rows": [[record.get(column) for column in columns] for record in records],
+    }
+
+
+def encode_response(response, key=None, encoding="json"):
+    """
+    Serialize a response, encoding the record list under key.
+
+    columnar replaces the records with to_columns(), zlib replaces them with
+    base64 of the zlib-compressed JSON, columnar+zlib does both. The encoding
+    used is named in the content-encoding field of the envelope.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+    if key is None:
+        return json.dumps(response)
+
+    records = response[key]
+    if encoding.startswith("columnar"):
+        records = to_columns(records)
+    if encoding.endswith("zlib"):
+        data = json.dumps(records, separators=(",", ":")).encode()
+        records = base64.b64encode(zlib.compress(data)).decode("ascii")
+
+    return json.dumps({**response, key: records, "content-encoding": encoding})
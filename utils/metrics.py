@@ -0,0 +1,158 @@
+import time
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram in the spirit of HdrHistogram.
+
+    Values are recorded in microseconds. Buckets keep the top SUB_BUCKET_BITS
+    bits of a value, which splits each power of two into 2**(SUB_BUCKET_BITS
+    - 1) linear sub-buckets: memory stays small while every reported
+    percentile is within about 3% of the recorded value.
+    """
+
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Drop all recorded values"""
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _bucket(self, value):
+        shift = max(0, value.bit_length() - self.SUB_BUCKET_BITS)
+        return (shift << self.SUB_BUCKET_BITS) | (value >> shift)
+
+    def _bucket_value(self, bucket):
+        """Highest value that falls into a bucket"""
+        shift = bucket >> self.SUB_BUCKET_BITS
+        sub_bucket = bucket & ((1 << self.SUB_BUCKET_BITS) - 1)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value_us):
+        """Record one latency in microseconds"""
+        value = max(0, int(value_us))
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Value at the given percentile (0-100) in microseconds"""
+        if not self.count:
+            return 0
+
+        target = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self._bucket_value(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class PollLatencyTracker:
+    """
+    Tracks the time between a POLL arriving from the VMC and the reply to it
+    being drained to the serial port, against the protocol response deadline.
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.histogram = LatencyHistogram()
+        self.polls = 0
+        self.deadline_misses = 0
+        self.window_start = time.time()
+        self._poll_received_at = None
+
+    def poll_received(self, timestamp):
+        """Mark the arrival time (time.perf_counter) of a POLL"""
+        self._poll_received_at = timestamp
+
+    def reply_sent(self, timestamp):
+        """Mark the first write drained after a POLL as its reply"""
+        if self._poll_received_at is None:
+            return
+
+        latency = timestamp - self._poll_received_at
+        self._poll_received_at = None
+        self.polls += 1
+        self.histogram.record(latency * 1_000_000)
+        if latency > self.deadline:
+            self.deadline_misses += 1
+
+    def snapshot(self, reset=False):
+        """Return the current statistics in milliseconds"""
+        histogram = self.histogram
+        now = time.time()
+        stats = {
+            "window_seconds": round(now - self.window_start, 1),
+            "polls": self.polls,
+            "deadline_ms": self.deadline * 1000,
+            "deadline_misses": self.deadline_misses,
+            "p50_ms": histogram.percentile(50) / 1000,
+            "p90_ms": histogram.percentile(90) / 1000,
+            "p99_ms": histogram.percentile(99) / 1000,
+            "max_ms": histogram.max / 1000,
+            "mean_ms": round(histogram.mean() / 1000, 3),
+        }
+
+        if reset:
+            histogram.reset()
+            self.polls = 0
+            self.deadline_misses = 0
+            self.window_start = now
+
+        return stats
+
+
+class TopicLatencyTracker:
+    """
+    Tracks the time from an MQTT command arriving to its handler finishing,
+    per topic.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.window_start = time.time()
+
+    def record(self, topic, latency):
+        """Record the handling time of one message in seconds"""
+        histogram = self.histograms.get(topic)
+        if histogram is None:
+            histogram = self.histograms[topic] = LatencyHistogram()
+        histogram.record(latency * 1_000_000)
+
+    def snapshot(self, reset=False):
+        """Return the current statistics per topic in milliseconds"""
+        now = time.time()
+        stats = {
+            "window_seconds": round(now - self.window_start, 1),
+            "topics": {
+                topic: {
+                    "count": histogram.count,
+                    "p50_ms": histogram.percentile(50) / 1000,
+                    "p99_ms": histogram.percentile(99) / 1000,
+                    "max_ms": histogram.max / 1000,
+                }
+                for topic, histogram in self.histograms.items()
+            },
+        }
+
+        if reset:
+            self.histograms = {}
+            self.window_start = now
+
+        return stats
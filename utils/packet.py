@@ -0,0 +1,131 @@
+from .commands import VMC_COMMANDS
+from .logger import vending_logger
+
+# Start of every VMC packet
+STX = b"\xfa\xfb"
+
+# XOR of the two STX bytes, folded into every outgoing checksum up front
+STX_XOR = STX[0] ^ STX[1]
+
+# STX (2) + Command (1) + Length (1) + XOR (1)
+MIN_PACKET_SIZE = 5
+
+
+def calculate_xor(data):
+    """XOR checksum over all bytes of a packet (without the XOR byte)"""
+    xor_value = 0
+    for b in data:
+        xor_value ^= b
+    return xor_value
+
+
+def encode_packet(command, packet_number, data=None):
+    """
+    Build a complete packet: STX + Command + Length + PackNO + Text + XOR.
+
+    The checksum is accumulated from the header fields instead of rescanning
+    the assembled packet, and the packet is joined in a single step.
+    """
+    if data:
+        length = len(data) + 1
+        xor_value = calculate_xor(data)
+    else:
+        data = b""
+        length = 1
+        xor_value = 0
+
+    xor_value ^= STX_XOR ^ command ^ length ^ packet_number
+    return b"".join(
+        (STX, bytes((command, length, packet_number)), data, bytes((xor_value,)))
+    )
+
+
+# Ready-made ACK packets indexed by packet number (1-255, 0 is unused)
+ACK_PACKETS = tuple(
+    encode_packet(VMC_COMMANDS["ACK"]["code"], number) for number in range(256)
+)
+
+
+class FrameParser:
+    """
+    Incremental parser for the VMC serial stream.
+
+    Incoming bytes are appended to a single buffer that is consumed through a
+    read offset, so a burst of packets is split without copying the remaining
+    bytes once per packet. Packets are handed out as memoryview slices of the
+    buffer and are only valid until the next call to feed().
+    """
+
+    # Consumed bytes kept at the head of the buffer before it is compacted
+    COMPACT_THRESHOLD = 4096
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """Append raw bytes read from the serial port"""
+        self._compact()
+        try:
+            self._buffer.extend(data)
+        except BufferError:
+            # A packet handed out earlier is still referenced somewhere, so
+            # the buffer cannot grow in place. Continue in a fresh buffer.
+            self._buffer = self._buffer[self._offset :] + data
+            self._offset = 0
+
+    def reset(self):
+        """Drop any buffered bytes"""
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def _compact(self):
+        """Drop consumed bytes once all of them are used or enough piled up"""
+        if not self._offset:
+            return
+        if (
+            self._offset < len(self._buffer)
+            and self._offset < self.COMPACT_THRESHOLD
+        ):
+            return
+        try:
+            del self._buffer[: self._offset]
+        except BufferError:
+            self._buffer = self._buffer[self._offset :]
+        self._offset = 0
+
+    def packets(self):
+        """Yield every complete packet with a valid checksum"""
+        buffer = self._buffer
+        end = len(buffer)
+
+        while end - self._offset >= MIN_PACKET_SIZE:
+            start = buffer.find(STX, self._offset)
+            if start == -1:
+                # Keep a trailing 0xFA, it may be the first half of an STX
+                self._offset = end - 1 if buffer[end - 1] == STX[0] else end
+                return
+
+            self._offset = start  # Skip bytes before STX
+            if end - start < MIN_PACKET_SIZE:
+                return
+
+            # Header + data + checksum
+            packet_end = start + buffer[start + 3] + MIN_PACKET_SIZE
+            if packet_end > end:
+                return
+
+            packet = memoryview(buffer)[start:packet_end]
+            if calculate_xor(packet[:-1]) != packet[-1]:
+                vending_logger.warning(
+                    f"Invalid checksum in packet: {packet.hex(' ')}"
+                )
+                # Resync on the next STX after the bad one
+                self._offset = start + 1
+                continue
+
+            self._offset = packet_end
+            yield packet